@@ -1,3 +1,4 @@
+from micropython import const
 from secrets import home
 
 """ Constant definitions """
@@ -17,15 +18,30 @@ WIFI_SSID = WIFI_CONFIG["ssid"]
 WIFI_PASSWORD = WIFI_CONFIG["pswd"]
 LED_POLARITY = "LO"
 
+# Sleep parameters
+SLEEP_MS = const(5000)   # time between two measurement cycles in ms
+DEEP_SLEEP = True        # True: reset on wake up (lowest power), False: light sleep and resume
+
+# Time synchronization
+NTP_SYNC_INTERVAL_S = const(3600)   # the RTC keeps running in deep sleep, resync it once per hour
+
+# Offline buffer deadband: a measurement this close to the last saved one is not buffered again
+SAVE_DEADBAND_L = 0.5               # liters
+SAVE_DEADBAND_C = 0.2               # °C
+SAVE_DEADBAND_HUM = 1.0             # %
+SAVE_HEARTBEAT_CYCLES = const(12)   # a measurement is still buffered after 12 skipped cycles
+
 # MQTT parameters
 MQTT_TOPIC_TANK = b"home/ext/oil_tank/measure/in_tank"
 MQTT_TOPIC_CASE = b"home/ext/oil_tank/measure/in_case"
+MQTT_TOPIC_HISTORY = None           # topic for the buffer replayed as one zlib-compressed message, None: one message per record
+FLUSH_COMPRESS_MIN_BYTES = const(512)   # smaller buffers are replayed record by record
 
 """ Pin definitions """
 # Temperature and humidity sensor (DHT22)
-DHT22_PIN = 2
+DHT22_PIN = const(2)
 # Ultrasonic level sensor (SR04)
-TX_PIN = 20
-RX_PIN = 21
+TX_PIN = const(20)
+RX_PIN = const(21)
 # LED indicator for WiFi status
-LED_PIN = 8
\ No newline at end of file
+LED_PIN = const(8)
\ No newline at end of file
@@ -3,6 +3,7 @@ Docstring for main
 """
 # General imports
 import ssl 
+import gc
 # Import config and utility functions
 from utils import *
 from config import *
@@ -13,11 +14,14 @@ from volume_calculator import HexagonalPrismTank
 from wifi_manager import WifiManager
 from mqtt_manager import MqttManager
 from secrets import mqtt_auth
+from micropython import const
+
+_DEBUG = const(0) # Set to 1 to print FSM state traces (dropped at compile time otherwise)
 
 """ Main program loop """
 
-print("Starting IoT Oil Tank Device...")
-print("Initializing components...")
+if _DEBUG: print("Starting IoT Oil Tank Device...")
+if _DEBUG: print("Initializing components...")
 temp_sensor = SensorDHT22(pin=DHT22_PIN, 
                            internal_pullup=False)
 
@@ -34,7 +38,8 @@ tank = HexagonalPrismTank(tank_length=TANK_LENGTH,
 wifi = WifiManager(ssid=WIFI_SSID, 
                     password=WIFI_PASSWORD,
                     led_pin=LED_PIN,
-                    led_polarity=LED_POLARITY)
+                    led_polarity=LED_POLARITY,
+                    verbose=bool(_DEBUG))   # WiFi traces only in debug builds, each one is a blocking UART write
 
 mqtt = MqttManager(client_id=b"oil_tank_device_",
                     broker_host="192.168.0.223",
@@ -44,95 +49,150 @@ mqtt = MqttManager(client_id=b"oil_tank_device_",
                     keepalive=60,
                     use_ssl=True,
                     ssl_params={"cert_reqs": ssl.CERT_NONE})
-print("Initialization complete. Entering main loop...")
+if _DEBUG: print("Initialization complete. Entering main loop...")
+
+# Collect after allocating a quarter of the free heap rather than only when an allocation fails
+gc.collect()
+gc.threshold(gc.mem_free() // 4)
+
+# MQTT message descriptors reused every cycle, only payload and QoS are updated
+msg_tank = {"topic": MQTT_TOPIC_TANK, "payload": b"", "retain": False, "qos": 0}
+msg_case = {"topic": MQTT_TOPIC_CASE, "payload": b"", "retain": False, "qos": 0}
+messages = [msg_tank, msg_case]
+
+""" FSM states """
+ST_MEASURE = const(0)
+ST_CONNECT = const(1)
+ST_FLUSH_DATA = const(2)
+ST_SAVE_DATA = const(3)
+ST_SEND_DATA = const(4)
+ST_SLEEP = const(5)
+
+# State labels for debug traces, indexed by state
+STATE_NAMES = ("MEASURE", "CONNECT", "FLUSH_DATA", "SAVE_DATA", "SEND_DATA", "SLEEP")
+
+""" FSM state handlers, each one returns the next state """
+
+def state_measure(ctx: dict) -> int:
+    # The values are written straight into the context, no result tuple per measurement
+    if measurment(ctx["temp_sensor"], ctx["level_sensor"], ctx["tank"], ctx):
+        return ST_CONNECT
+    return ST_MEASURE
+
+def state_connect(ctx: dict) -> int:
+    connection_result = connection(ctx["wifi"])
+
+    if connection_result is True:
+        ctx["mqtt"].connect()
+        if rtc_sync_due(NTP_SYNC_INTERVAL_S):
+            update_rtc()
+        next_state = ST_FLUSH_DATA
+    elif connection_result is False:
+        next_state = ST_SAVE_DATA
+    else:
+        return ST_CONNECT
+
+    # Serialize the measurement once, reused by SAVE_DATA and SEND_DATA
+    current_date, current_time = localtime_brussels()
+    msg_tank["payload"] = tank_to_json(current_date, current_time, ctx["liters"])
+    msg_case["payload"] = case_to_json(current_date, current_time, ctx["temp"], ctx["hum"])
+    return next_state
+
+def state_flush_data(ctx: dict) -> int:
+    success = flush_data(ctx["mqtt"],
+                         history_topic=MQTT_TOPIC_HISTORY,
+                         compress_min_bytes=FLUSH_COMPRESS_MIN_BYTES)
+    # The flush batches and the compressed history are garbage now, free them before sending
+    cleanup(force=True)
+
+    if success:
+        return ST_SEND_DATA
+
+    print("[ERROR] Failed to flush data, will retry later")
+    return ST_SAVE_DATA
+
+def state_save_data(ctx: dict) -> int:
+    liters, temp, hum = ctx["liters"], ctx["temp"], ctx["hum"]
+
+    # Skip the flash write when nothing changed since the last saved measurement
+    if not save_needed(liters, temp, hum,
+                       deadband_l=SAVE_DEADBAND_L,
+                       deadband_c=SAVE_DEADBAND_C,
+                       deadband_hum=SAVE_DEADBAND_HUM,
+                       heartbeat=SAVE_HEARTBEAT_CYCLES):
+        return ST_SLEEP
+
+    # Buffered messages are replayed with QoS 1 to make sure they reach the broker
+    msg_tank["qos"] = msg_case["qos"] = 1
+
+    success = save_data(messages=messages)
+    if success:
+        mark_saved(liters, temp, hum)
+    else:
+        print("[ERROR] Failed to save data")
+
+    return ST_SLEEP
+
+def state_send_data(ctx: dict) -> int:
+    msg_tank["qos"] = msg_case["qos"] = 0
+
+    success = send_data(ctx["mqtt"], messages=messages)
+    if success:
+        return ST_SLEEP
+
+    print("[ERROR] Failed to send data")
+    return ST_SAVE_DATA
+
+def state_sleep(ctx: dict) -> int:
+    ctx["mqtt"].disconnect()
+
+    # Nothing large is alive between two cycles, compact the heap at this deterministic point
+    gc.collect()
+    if _DEBUG:
+        print("[GC] Free memory:", gc.mem_free())
+        print("-------------------------------")
+    go_sleep(ctx["wifi"], duration_ms=SLEEP_MS, deep=DEEP_SLEEP)
+
+    return ST_MEASURE
+
+# Handlers indexed by state
+STATES = (
+    state_measure,      # ST_MEASURE
+    state_connect,      # ST_CONNECT
+    state_flush_data,   # ST_FLUSH_DATA
+    state_save_data,    # ST_SAVE_DATA
+    state_send_data,    # ST_SEND_DATA
+    state_sleep,        # ST_SLEEP
+)
+
+# Shared FSM context: components and the values of the current cycle
+ctx = {
+    "temp_sensor": temp_sensor,
+    "level_sensor": level_sensor,
+    "tank": tank,
+    "wifi": wifi,
+    "mqtt": mqtt,
+    "temp": None,
+    "hum": None,
+    "liters": None,
+}
+
+def run(ctx: dict) -> None:
+    """ Run the FSM forever, the loop works on locals instead of module globals """
+    states = STATES
+    state = ST_MEASURE
+    if _DEBUG: print("[STATE]", STATE_NAMES[state])
+
+    while True:
+        next_state = states[state](ctx)
+        if _DEBUG:
+            if next_state != state: print("[STATE]", STATE_NAMES[next_state])
+        state = next_state
 
 wifi.start()
-state = "MEASURE"
 
 try: 
-    while True:            
-        if state == "MEASURE":
-            print("[STATE] MEASURE")
-            temp, hum, liters = measurment(temp_sensor, level_sensor, tank)
-            if None not in (temp, hum, liters):
-                state = "CONNECT"
-                print("[STATE] CONNECT")
-
-        elif state == "CONNECT":
-            connection_result = connection(wifi)
-            
-            if connection_result is True:
-                mqtt_result = mqtt.connect()
-                update_rtc()
-                current_date, current_time = localtime_brussels()
-                state = "FLUSH_DATA"
-            elif connection_result is False:
-                current_date, current_time = localtime_brussels()
-                state = "SAVE_DATA"
-            
-        elif state == "FLUSH_DATA":
-            print("[STATE] FLUSH_DATA")
-            success = flush_data(mqtt)
-
-            if success:
-                state = "SEND_DATA"
-            else:
-                print("[ERROR] Failed to flush data, will retry later")
-                state = "SAVE_DATA"
-        
-        elif state == "SAVE_DATA":
-            print("[STATE] SAVE_DATA")
-
-            data_tank = data_to_json(date=current_date,
-                                     time=current_time,
-                                     quantity_l=liters)
-            
-            data_case = data_to_json(date=current_date,
-                                     time=current_time,
-                                     temp_c=temp, hum=hum)
-
-            messages_to_buffer = [
-                {"topic": MQTT_TOPIC_TANK, "payload": data_tank, "retain": False, "qos": 1},
-                {"topic": MQTT_TOPIC_CASE, "payload": data_case, "retain": False, "qos": 1}
-            ]
-
-            success = save_data(messages=messages_to_buffer)
-            if not success:
-                print("[ERROR] Failed to save data")
-
-            state = "SLEEP"
-
-        elif state == "SEND_DATA":
-            print("[STATE] SEND_DATA")
-            
-            data_tank = data_to_json(date=current_date,
-                                     time=current_time,
-                                     quantity_l=liters)
-            
-            data_case = data_to_json(date=current_date,
-                                     time=current_time,
-                                     temp_c=temp,
-                                     hum=hum)
-
-            msg_to_send = [
-                {"topic": MQTT_TOPIC_TANK, "payload": data_tank, "retain": False, "qos": 0},
-                {"topic": MQTT_TOPIC_CASE, "payload": data_case, "retain": False, "qos": 0}
-            ]
-
-            success = send_data(mqtt, messages=msg_to_send)
-            if success:
-                state = "SLEEP"
-            else:
-                print("[ERROR] Failed to send data")
-                state = "SAVE_DATA"
-
-        elif state == "SLEEP":
-            print("[STATE] SLEEP")
-            print("-------------------------------")
-            mqtt.disconnect()
-            go_sleep(wifi)
-
-            state = "MEASURE"
+    run(ctx)
 
 except KeyboardInterrupt:
     print("Program interrupted by user")
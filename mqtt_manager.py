@@ -1,7 +1,19 @@
 import ubinascii
+import select
+import errno
 from machine import unique_id
-from utime import sleep_ms
+from utime import sleep_ms, ticks_ms, ticks_add, ticks_diff
 from umqtt.simple import MQTTClient
+from micropython import const
+
+_DEBUG = const(0) # Set to 1 to print publish traces (dropped at compile time otherwise)
+
+_MAX_WRITE_BYTES = const(1390)  # TCP payload of one segment on a WiFi link
+_MAX_INFLIGHT = const(10)       # QoS 1 messages sent before waiting for their PUBACK
+_ACK_TIMEOUT_MS = const(5000)   # time to wait for one PUBACK before the batch is considered lost
+
+# The chip ID never changes, hexlify it once for every client instance
+_UID_HEX = ubinascii.hexlify(unique_id())
 
 class MqttManager:
     def __init__(self,
@@ -14,7 +26,7 @@ class MqttManager:
                  use_ssl: bool = False,
                  ssl_params: dict = None) -> None:
         # Generate a unique client ID by appending the device's unique ID to the provided client_id prefix
-        self._client_id = client_id + ubinascii.hexlify(unique_id())
+        self._client_id = client_id + _UID_HEX
         self._broker_host = broker_host
         self._broker_port = broker_port
         self._user = user
@@ -22,13 +34,21 @@ class MqttManager:
         self._keepalive = keepalive
         self._use_ssl = use_ssl
         self._ssl_params = ssl_params
-        self._client = None
+        self._client = None         # created once on first connect, umqtt opens a new socket on each connect()
+        self._connected = False
         
     
     def connect(self,
-                retry: int = 3,
-                retry_delay_ms: int = 500) -> bool:                                    # TODO: evaluate optimal retry delay and count
-        for attempt in range(retry):
+                timeout_ms: int = 3000,
+                retry_delay_ms: int = 100) -> bool:
+        """
+        Connect to the broker, retrying with an exponential backoff until the deadline expires.
+
+        :param timeout_ms: Time budget for all the attempts in milliseconds, at least one attempt is made.
+        :param retry_delay_ms: Delay before the first retry in milliseconds, doubled after each failure.
+        :return: True if connected, False otherwise
+        """
+        if self._client is None:
             self._client = MQTTClient(self._client_id,
                                       self._broker_host,
                                       self._broker_port,
@@ -37,40 +57,158 @@ class MqttManager:
                                       keepalive=self._keepalive,
                                       ssl=self._use_ssl,
                                       ssl_params=self._ssl_params)
+        deadline = ticks_add(ticks_ms(), timeout_ms)
+        delay = retry_delay_ms
+        while True:
             try:
                 self._client.connect()
+                self._connected = True
                 print("[MQTT] Connected to broker.")
                 return True
             except Exception as e:
                 print("[MQTT] connection failed:", e)
-                if attempt < retry - 1:
-                    sleep_ms(retry_delay_ms)
-        self._client = None
-        return False
+                self._close_socket()
+
+            remaining = ticks_diff(deadline, ticks_ms())
+            if remaining <= 0:
+                return False
+            sleep_ms(min(delay, remaining))
+            delay *= 2
     
     def disconnect(self) -> None:
-        if self._client is not None:
+        if self._connected:
             try:
                 self._client.disconnect()
             finally:
-                self._client = None
+                self._connected = False
                 print("[MQTT] Disconnected from broker.")
+
+    def _close_socket(self) -> None:
+        # Release the socket of a failed attempt before the client opens a new one
+        sock = self._client.sock
+        if sock is not None:
+            try:
+                sock.close()
+            except OSError:
+                pass
+            self._client.sock = None
         
     def publish(self, 
                 topic: bytes,
                 message: bytes,
                 retain: bool = False,
                 qos: int = 0) -> bool:
-        if self._client is None:
+        if not self._connected:
             if not self.connect():
                 print("[MQTT] Publish failed: Not connected to broker.")
                 return False
         try:
             self._client.publish(topic, message, retain=retain, qos=qos)
-            print(f"[MQTT] Published to {topic.decode()}")
+            if _DEBUG: print("[MQTT] Published to", topic)
+            return True
+        except Exception as e:
+            print("[MQTT] Publish failed:", e)
+            return False
+
+    def _wait_acks(self,
+                   pending: list,
+                   keep: int) -> None:
+        """
+        Read PUBACKs until at most keep packet IDs are still waiting.
+
+        :param pending: Packet IDs waiting for their PUBACK, acknowledged ones are removed.
+        :param keep: Number of unacknowledged packets allowed to stay in flight.
+        :raises OSError: ETIMEDOUT if no expected PUBACK arrives within _ACK_TIMEOUT_MS.
+        """
+        client = self._client
+        sock = client.sock
+        # The TLS socket has no settimeout, the wait is bounded by polling it before each packet
+        poller = select.poll()
+        poller.register(sock, select.POLLIN)
+        deadline = ticks_add(ticks_ms(), _ACK_TIMEOUT_MS)
+        while len(pending) > keep:
+            remaining = ticks_diff(deadline, ticks_ms())
+            if remaining <= 0 or not poller.poll(remaining):
+                raise OSError(errno.ETIMEDOUT)
+            op = client.wait_msg()
+            if op is None:
+                continue                    # PINGRESP or incoming PUBLISH, already consumed by umqtt
+            # wait_msg leaves the body of other packets unread, read it whole to stay in sync
+            body = sock.read(client._recv_len())
+            if op == 0x40:                  # PUBACK: packet ID
+                pid = (body[0] << 8) | body[1]
+                if pid in pending:
+                    pending.remove(pid)
+                    deadline = ticks_add(ticks_ms(), _ACK_TIMEOUT_MS)  # the broker is alive, time the next one
+
+    def publish_batch(self,
+                      messages: list[dict],
+                      max_write_bytes: int = _MAX_WRITE_BYTES,
+                      max_inflight: int = _MAX_INFLIGHT) -> bool:
+        """
+        Publish several messages with as few socket writes as possible.
+
+        umqtt.simple issues four writes per publish (header, topic length, topic, payload) and
+        waits for the PUBACK of a QoS 1 message before the next one. Here the PUBLISH packets are
+        serialized back to back and written in groups of at most max_write_bytes, the PUBACKs of
+        QoS 1 messages are only awaited once max_inflight of them are unacknowledged or everything is sent.
+
+        :param messages: List of dictionaries containing 'topic', 'payload', and optional 'retain' and 'qos'.
+        :param max_write_bytes: Size of a socket write, one TCP segment on a WiFi link.
+        :param max_inflight: Number of QoS 1 messages sent ahead of their PUBACK.
+        :return: True if every message was written and acknowledged, False otherwise
+        """
+        if not self._connected:
+            if not self.connect():
+                print("[MQTT] Publish failed: Not connected to broker.")
+                return False
+
+        client = self._client
+        buf = bytearray()
+        pending = []                        # packet IDs waiting for their PUBACK
+        try:
+            for msg in messages:
+                topic = msg["topic"]
+                payload = msg["payload"]
+                qos = msg.get("qos", 0)
+
+                buf.append(0x30 | (qos << 1) | (1 if msg.get("retain", False) else 0))
+                size = 2 + len(topic) + len(payload)
+                if qos:
+                    size += 2                   # packet ID
+                while size > 0x7F:              # remaining length, variable length encoding
+                    buf.append((size & 0x7F) | 0x80)
+                    size >>= 7
+                buf.append(size)
+                buf.append(len(topic) >> 8)
+                buf.append(len(topic) & 0xFF)
+                buf.extend(topic)
+                if qos:
+                    pid = client.pid = client.pid % 0xFFFF + 1  # shared with umqtt, 0 is not a valid ID
+                    buf.append(pid >> 8)
+                    buf.append(pid & 0xFF)
+                    pending.append(pid)
+                buf.extend(payload)
+
+                inflight_full = len(pending) >= max_inflight
+                if len(buf) >= max_write_bytes or inflight_full:
+                    client.sock.write(buf)
+                    buf = bytearray()
+                if inflight_full:
+                    # Let the broker catch up before sending more, half the window stays in flight
+                    self._wait_acks(pending, max_inflight // 2)
+            if buf:
+                client.sock.write(buf)
+
+            self._wait_acks(pending, 0)
+
+            if _DEBUG: print("[MQTT] Published", len(messages), "messages")
             return True
         except Exception as e:
             print("[MQTT] Publish failed:", e)
+            # The stream is out of sync after a partial write, reconnect on the next publish
+            self._close_socket()
+            self._connected = False
             return False
 
 if __name__ == "__main__":
@@ -1,6 +1,10 @@
+import micropython
 from machine import Pin
 from utime import ticks_ms, ticks_diff
 import dht
+from micropython import const
+
+_MIN_INTERVAL = const(2000) # Minimum interval between readings in milliseconds (required by DHT22)
 
 class SensorDHT22:
     """
@@ -14,8 +18,8 @@ class SensorDHT22:
 
     Attributes:
         sensor (dht.DHT22): The DHT22 sensor object.
-        temperature (float | None): Last measured temperature in °C.
-        humidity (float | None): Last measured humidity in %.
+        temperature (float | None): Last measured temperature in °C, None after a failed measurement.
+        humidity (float | None): Last measured humidity in %, None after a failed measurement.
 
     Methods:
         read() -> tuple[float, float] | tuple[None, None]:
@@ -23,8 +27,6 @@ class SensorDHT22:
             If the sensor fails, (None, None) is returned.
     """
 
-    MIN_INTERVAL = 2000 # Minimum interval between readings in milliseconds (required by DHT22)
-
     def __init__(self,
                  pin: int,
                  internal_pullup: bool = False) -> None:
@@ -32,32 +34,47 @@ class SensorDHT22:
             self.sensor = dht.DHT22(Pin(pin, Pin.IN, Pin.PULL_UP))
         else:
             self.sensor = dht.DHT22(Pin(pin, Pin.IN))
+
+        # Bound driver methods to skip the attribute lookups on every read
+        self._measure = self.sensor.measure
+        self._temperature = self.sensor.temperature
+        self._humidity = self.sensor.humidity
         
         self.temperature: float | None = None
         self.humidity: float | None = None
 
-        self._last_read_time = ticks_ms() - self.MIN_INTERVAL  # Initialize to allow immediate first read
+        self._last_read_time = ticks_ms() - _MIN_INTERVAL  # Initialize to allow immediate first read
 
+    @micropython.native
     def read(self) -> tuple[float, float] | tuple[None, None]:
         """
         Read temperature and humidity from the DHT22 sensor.
+
+        Compiled with the native emitter, the wrapper runs as machine code around the C driver.
         
         :return: Tuple containing temperature in °C and humidity in %
         """
         now = ticks_ms()
-        if ticks_diff(now, self._last_read_time) < self.MIN_INTERVAL:
+        if ticks_diff(now, self._last_read_time) < _MIN_INTERVAL:
             # If the minimum interval has not passed, return the last read values
-            return self.temperature, self.humidity
-        
+            if self.temperature is None or self.humidity is None:
+                return None, None
+            return round(self.temperature, 1), round(self.humidity, 1)
+
+        # The interval applies to every attempt, a failed measurement also needs the sensor to rest
+        self._last_read_time = now
         try:
-            self.sensor.measure()                           # start measurement
-            self.temperature = self.sensor.temperature()    # get temperature in °C
-            self.humidity = self.sensor.humidity()          # get humidity in %
-            self._last_read_time = now
+            self._measure()                                 # start measurement
+            self.temperature = self._temperature()          # get temperature in °C
+            self.humidity = self._humidity()                # get humidity in %
         except OSError:
             print('Sensor reading failed.')
-        finally:
-            return round(self.temperature, 1), round(self.humidity, 1)
+            # Forget the last values, a retry inside the interval must not report them as a fresh reading
+            self.temperature = None
+            self.humidity = None
+            return None, None
+
+        return round(self.temperature, 1), round(self.humidity, 1)
     
 if __name__ == "__main__":
     from utime import sleep
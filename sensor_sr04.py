@@ -1,8 +1,178 @@
+import micropython
+from array import array
 from machine import Pin, time_pulse_us, UART
 from utime import sleep, sleep_ms, sleep_us
 
 DEFAULT_OFFSET = 20.0 # default sensor blind zone in cm
 
+# ESP32-C3 GPIO output registers: writing a pin mask sets/clears only those pins
+GPIO_OUT_W1TS_REG = 0x60004008
+GPIO_OUT_W1TC_REG = 0x6000400C
+
+def _half_sound_speed(temperature_c: float) -> int:
+    """
+    Half speed of sound, the one-way distance per microsecond of echo, in 0.1 mm per 4096 us.
+
+    :param temperature_c: Temperature in degrees Celsius.
+    :return: Half speed of sound (integer)
+    """
+    # (331.3 + 0.606 * t) m/s scaled to dm/s and rounded, folded into a single multiply-add
+    speed_dm_s = int(3313.5 + 6.06 * temperature_c)
+    # dm/s * 4096 / 2000 = 0.1 mm per 4096 us for the one-way trip, rounded
+    return ((speed_dm_s << 11) + 500) // 1000
+
+# Half speed of sound from -20 to +50 °C in 0.5 °C steps, the tank and enclosure range
+_SPEED_TABLE_MIN_C = -20.0
+_SPEED_TABLE_MAX_C = 50.0
+_SPEED_TABLE = array('H', [_half_sound_speed(i * 0.5 + _SPEED_TABLE_MIN_C) for i in range(141)])
+
+@micropython.viper
+def _trig_pulse(set_reg: uint, clr_reg: uint, mask: uint, pulse_us):
+    """
+    Drive a trigger pulse by writing the GPIO set/clear registers directly.
+
+    :param set_reg: Address of the GPIO output set register.
+    :param clr_reg: Address of the GPIO output clear register.
+    :param mask: Bit mask of the trigger pin.
+    :param pulse_us: Duration of the high level in microseconds.
+    :return: None
+    """
+    gpio_set = ptr32(set_reg)
+    gpio_clr = ptr32(clr_reg)
+    gpio_clr[0] = mask
+    sleep_us(2)
+    gpio_set[0] = mask
+    sleep_us(pulse_us)
+    gpio_clr[0] = mask
+
+@micropython.viper
+def _median5(samples) -> int:
+    """
+    Return the median of the first 5 items of an array('i') with a sorting network.
+
+    :param samples: array('i') holding at least 5 values.
+    :return: Median value.
+    """
+    buf = ptr32(samples)
+    a = buf[0]
+    b = buf[1]
+    c = buf[2]
+    d = buf[3]
+    e = buf[4]
+    if a > b:
+        t = a; a = b; b = t
+    if d > e:
+        t = d; d = e; e = t
+    if a > d:
+        t = a; a = d; d = t
+    if b > e:
+        t = b; b = e; e = t
+    if b > c:
+        t = b; b = c; c = t
+    if c > d:
+        t = c; c = d; d = t
+    if b > c:
+        t = b; b = c; c = t
+    return c
+
+@micropython.native
+def _median5_values(a, b, c, d, e):
+    """
+    Return the median of 5 values with the same sorting network as _median5.
+
+    :return: Median value.
+    """
+    if a > b:
+        a, b = b, a
+    if d > e:
+        d, e = e, d
+    if a > d:
+        a, d = d, a
+    if b > e:
+        b, e = e, b
+    if b > c:
+        b, c = c, b
+    if c > d:
+        c, d = d, c
+    if b > c:
+        b, c = c, b
+    return c
+
+class MedianStream:
+    """
+    Running median over the last values pushed.
+
+    Values are kept twice: in arrival order in a ring buffer and sorted. Each push removes the
+    oldest value from the sorted array and inserts the new one in place, no full sort is done.
+
+    Args:
+        window (int, optional): Number of values the median is taken on. Default is 5.
+
+    Methods:
+        push(value: float) -> float:
+            Add a value and return the median of the window.
+        median() -> float | None:
+            Return the median of the window, None if no value was pushed yet.
+    """
+    def __init__(self,
+                 window: int = 5) -> None:
+        self._window = window
+        self._ring = array('f', [0.0] * window)
+        self._sorted = array('f', [0.0] * window)
+        self._head = 0
+        self._count = 0
+
+    @micropython.native
+    def push(self,
+             value: float) -> float:
+        """
+        Add a value to the window and return the updated median.
+
+        :param value: New value.
+        :return: Median of the window.
+        """
+        ring = self._ring
+        srt = self._sorted
+        count = self._count
+
+        if count == self._window:
+            # Window full: remove the oldest value from the sorted array
+            oldest = ring[self._head]
+            i = 0
+            while srt[i] != oldest:
+                i += 1
+            while i < count - 1:
+                srt[i] = srt[i + 1]
+                i += 1
+            count -= 1
+
+        ring[self._head] = value
+        value = ring[self._head]    # same precision as the stored copies
+        self._head = (self._head + 1) % self._window
+
+        # Insert the new value at its sorted position
+        i = count
+        while i > 0 and srt[i - 1] > value:
+            srt[i] = srt[i - 1]
+            i -= 1
+        srt[i] = value
+        self._count = count + 1
+
+        return self.median()
+
+    def median(self) -> float | None:
+        """
+        Return the median of the window.
+
+        :return: Median of the values in the window, None if the window is empty.
+        """
+        count = self._count
+        if not count:
+            return None
+        srt = self._sorted
+        mid = count // 2
+        return srt[mid] if count % 2 else (srt[mid - 1] + srt[mid]) / 2
+
 class BaseSR04:
     """
     Base class for SR04 ultrasonic distance sensor.
@@ -13,11 +183,20 @@ class BaseSR04:
     Methods:
         read(samples: int = 5, delay: int = 50, temperature_c: float = 20.0) -> float:
             Read the distance from the sensor multiple times and return the median value.
+        read_filtered(temperature_c: float = 20.0, window: int = 5) -> float:
+            Take a single sample and return the running median of the last samples.
     """
     def __init__(self, 
                  sensor_offset: float = DEFAULT_OFFSET) -> None:
         self.sensor_offset = sensor_offset
 
+        # sample buffer reused by read(), allocated on first use for the requested sample count
+        self._buf = None
+
+        # running median used by read_filtered(), allocated on first use
+        self._filter = None
+
+    @micropython.native
     def read(self, 
              samples: int = 5,
              delay: int = 50,
@@ -28,33 +207,69 @@ class BaseSR04:
         :param samples: Number of samples to take
         :param delay: Delay between samples in milliseconds
         :param temperature_c: Temperature in degrees Celsius
-        :return: Median distance from the sensor to the object in centimeters
+        :return: Median distance from the sensor to the object in centimeters, or -1.0 if no sample was valid
         """
-        distances = []
+        buf = self._buf
+        if buf is None or len(buf) != samples:
+            buf = self._buf = array('f', [0.0] * samples)
+
+        read_once = self.read_once
+        _sleep_ms = sleep_ms
+        count = 0
         attempts = 0
         max_attempts = samples * 2  # to avoid infinite loop in case of continuous failures
 
-        while len(distances) < samples and attempts < max_attempts:
-            distance = self.read_once(temperature_c)
+        while count < samples and attempts < max_attempts:
+            distance = read_once(temperature_c)
             if distance >= 0:
-                distances.append(distance)
+                buf[count] = distance
+                count += 1
 
             attempts += 1
-            sleep_ms(delay)
+            if count < samples and attempts < max_attempts:
+                _sleep_ms(delay)    # wait between samples only, not after the last one
 
-        if not distances:
-            raise RuntimeError("Sensor read timeout or invalid measurement")
+        if not count:
+            return -1.0  # indicate timeout or invalid measurement
 
-        distances.sort()
-        num_distances = len(distances)
-        if num_distances % 2:
+        if count == 5:
+            # Default sample count, median from a sorting network without sorting
+            return _median5_values(buf[0], buf[1], buf[2], buf[3], buf[4])
+
+        distances = sorted(buf[:count] if count < samples else buf)
+        if count % 2:
             # If odd number of samples
-            return round(distances[num_distances // 2], 2)
+            return distances[count // 2]
         else:
             # If even number of samples
-            mid = num_distances // 2
-            return round((distances[mid - 1] + distances[mid]) / 2, 2)
+            mid = count // 2
+            return (distances[mid - 1] + distances[mid]) / 2
         
+    def read_filtered(self,
+                      temperature_c: float = 20.0,
+                      window: int = 5) -> float:
+        """
+        Take a single sample and return the running median of the last samples.
+
+        Meant for a loop that keeps the sensor object alive (no deep sleep): each update costs
+        one trigger and echo instead of a full read().
+
+        :param temperature_c: Temperature in degrees Celsius
+        :param window: Number of samples the median is taken on
+        :return: Running median distance in centimeters, or -1.0 if no sample was valid yet
+        """
+        stream = self._filter
+        if stream is None or stream._window != window:
+            stream = self._filter = MedianStream(window)
+
+        distance = self.read_once(temperature_c)
+        if distance >= 0:
+            return stream.push(distance)
+
+        # Invalid sample, keep the current median
+        median = stream.median()
+        return -1.0 if median is None else median
+
 class PulseSR04(BaseSR04):
     """
     Class to handle SR04 ultrasonic distance sensor using pulse measurement.
@@ -73,6 +288,8 @@ class PulseSR04(BaseSR04):
             Default is False.
 
     Methods:
+        read(samples: int = 5, delay: int = 50, temperature_c: float = 20.0) -> float:
+            Read the distance multiple times and return the median value.
         read_once(temperature_c: float = 20.0) -> float:
             Perform a single distance measurement and return the distance in centimeters.
     """
@@ -86,68 +303,110 @@ class PulseSR04(BaseSR04):
         super().__init__(sensor_offset)
         self.trig = Pin(trig_pin, Pin.OUT)
         self.echo = Pin(echo_pin, Pin.IN)
+        self._trig_mask = 1 << trig_pin
         self.timeout_us = timeout_us
 
         # For low power mode, we can use a longer trigger pulse to ensure the sensor wakes up properly,
         self._trig_duration_us = 2000 if low_power else 10
 
-        # cache for speed of sound based on temperature to avoid recalculating it every measurement
-        self._cached_speed : float | None = None
-        self._cached_temp_c : float | None = None
-    
-    def _trigger(self) -> None:
-        """
-        Send a trigger pulse to the ultrasonic sensor.
+        # sensor offset in 0.1 mm to keep the distance calculation in integer arithmetic
+        self._offset_q = int(round(sensor_offset * 100))
 
-        :param duration_us: Duration of the trigger pulse in microseconds.
-        :return: None
-        """
-        self.trig.value(0)
-        sleep_us(2)
-        self.trig.value(1)
-        sleep_us(self._trig_duration_us)
-        self.trig.value(0)
-     
-    def _measure_echo(self) -> float:
+        # raw echo durations collected by read(), filtered with _median5()
+        self._durations = array('i', [0] * 5)
+
+    @micropython.native
+    def read(self,
+             samples: int = 5,
+             delay: int = 50,
+             temperature_c: float = 20.0) -> float:
         """
-        Measure the duration of the echo pulse.
+        Read the distance from the sensor multiple times and return the median value.
 
-        :return: Duration of the echo pulse in microseconds with negative value indicating timeout or error.
+        The median is taken on the raw echo durations (a native sorting network for 5 samples)
+        and converted to centimeters once.
+
+        :param samples: Number of samples to take
+        :param delay: Delay between samples in milliseconds
+        :param temperature_c: Temperature in degrees Celsius
+        :return: Median distance from the sensor to the object in centimeters, or -1.0 if no sample was valid
         """
-        return time_pulse_us(self.echo, 1, self.timeout_us)
+        if samples != 5:
+            return BaseSR04.read(self, samples, delay, temperature_c)
+
+        durations = self._durations
+        trig_mask = self._trig_mask
+        trig_duration_us = self._trig_duration_us
+        echo = self.echo
+        timeout_us = self.timeout_us
+        _sleep_ms = sleep_ms
+        count = 0
+        attempts = 0
+        max_attempts = samples * 2  # to avoid infinite loop in case of continuous failures
+
+        while count < samples and attempts < max_attempts:
+            _trig_pulse(GPIO_OUT_W1TS_REG, GPIO_OUT_W1TC_REG, trig_mask, trig_duration_us)
+            duration = time_pulse_us(echo, 1, timeout_us)
+            if duration >= 0:
+                durations[count] = duration
+                count += 1
+
+            attempts += 1
+            if count < samples and attempts < max_attempts:
+                _sleep_ms(delay)    # wait between samples only, not after the last one
+
+        if count == samples:
+            duration = _median5(durations)
+        elif count:
+            valid = sorted(durations[:count])
+            mid = count // 2
+            duration = valid[mid] if count % 2 else (valid[mid - 1] + valid[mid]) // 2
+        else:
+            return -1.0  # indicate timeout or invalid measurement
+
+        half_speed = self._calc_sound_speed(temperature_c)
+        return self._raw_to_distance(duration, half_speed)
     
+    @micropython.native
     def _calc_sound_speed(self,
-                          temperature_c: float) -> float:
+                          temperature_c: float) -> int:
         """
         Calculate the speed of sound in air based on temperature.
 
+        The half speed, the one-way distance per microsecond of echo, is looked up in a table
+        in 0.1 mm per 4096 us so _raw_to_distance only needs a multiply and a shift.
+        Temperatures outside the table are computed.
+
         :param temperature_c: Temperature in degrees Celsius.
-        :return: Speed of sound in cm/us
+        :return: Half speed of sound in 0.1 mm per 4096 us (integer)
         """
-        if self._cached_temp_c == temperature_c and self._cached_speed is not None:
-            return self._cached_speed
-        
-        speed_m_s = 331.3 + (0.606 * temperature_c)     # speed of sound in m/s
-        speed_cm_us = speed_m_s / 10_000                # convert to cm/us
-        self._cached_speed = speed_cm_us
-        self._cached_temp_c = temperature_c
-        return speed_cm_us
+        if _SPEED_TABLE_MIN_C <= temperature_c <= _SPEED_TABLE_MAX_C:
+            # nearest 0.5 °C step, 0.25 °C moves the speed of sound by less than 0.05 %
+            return _SPEED_TABLE[int((temperature_c - _SPEED_TABLE_MIN_C) * 2 + 0.5)]
+        return _half_sound_speed(temperature_c)
     
+    @micropython.native
     def _raw_to_distance(self,
-                         duration_us: float,
-                         sound_speed: float) -> float:
+                         duration_us: int,
+                         half_speed: int) -> float:
         """
         Convert the raw echo duration to distance in centimeters.
 
+        The distance is computed in 0.1 mm units with integer arithmetic, the 4096 scale of
+        the half speed is removed with a shift instead of a division.
+        Products stay below 2^30 (30 ms timeout * 8192), so no big integer is allocated.
+
         :param duration_us: Duration of the echo pulse in microseconds.
-        :param sound_speed: Speed of sound in cm/us.
+        :param half_speed: Half speed of sound in 0.1 mm per 4096 us, from _calc_sound_speed.
         :return: Distance from the sensor to the object in centimeters.
         """
         if duration_us < 0:
             return -1.0  # indicate timeout or error
         
-        return ((duration_us * sound_speed) / 2.0) - self.sensor_offset
+        distance_q = (duration_us * half_speed) >> 12        # distance in 0.1 mm
+        return (distance_q - self._offset_q) / 100
 
+    @micropython.native
     def read_once(self,
                   temperature_c: float = 20.0) -> float:
         """
@@ -156,10 +415,10 @@ class PulseSR04(BaseSR04):
         :param temperature_c: Temperature in degrees Celsius.
         :return: Distance from the sensor to the object in centimeters.
         """
-        self._trigger()
-        duration = self._measure_echo()
-        speed_cm_us = self._calc_sound_speed(temperature_c)
-        return self._raw_to_distance(duration, speed_cm_us)
+        _trig_pulse(GPIO_OUT_W1TS_REG, GPIO_OUT_W1TC_REG, self._trig_mask, self._trig_duration_us)
+        duration = time_pulse_us(self.echo, 1, self.timeout_us)    # negative on timeout or error
+        half_speed = self._calc_sound_speed(temperature_c)
+        return self._raw_to_distance(duration, half_speed)
 
 class SerialSR04(BaseSR04):
     """
@@ -205,7 +464,13 @@ class SerialSR04(BaseSR04):
                          tx=self.tx,
                          rx=self.rx,
                          timeout=uart_timeout_ms)
+
+        # Bound UART methods, read_once polls them in a loop
+        self._uart_any = self.uart.any
+        self._uart_read = self.uart.read
+        self._uart_write = self.uart.write
     
+    @micropython.native
     def read_once(self,
                   _temperature_c: float = 20.0) -> float:
         """
@@ -217,16 +482,19 @@ class SerialSR04(BaseSR04):
         
         check_interval_ms = self.timeout_ms // self.check_attempts        
 
+        uart_any = self._uart_any
+        uart_read = self._uart_read
+
         # clear any existing data in the buffer
-        self.uart.read()
+        uart_read()
 
         # send trigger command
-        self.uart.write(b'\x01')
+        self._uart_write(b'\x01')
         
         # data format: [0xFF, high_byte, low_byte, checksum]
         for _ in range(self.check_attempts):
-            if self.uart.any() >= 4:
-                data = self.uart.read(4)
+            if uart_any() >= 4:
+                data = uart_read(4)
 
                 # validate data format and checksum
                 # calculation: (0xFF + high_byte + low_byte) & 0xFF == Checksum
@@ -242,6 +510,7 @@ class SerialSR04(BaseSR04):
             return -1.0  # indicate timeout or error            
 
 if __name__ == "__main__":
+    from machine import lightsleep
     from volume_calculator import HexagonalPrismTank
 
     offset = 20.0 # sensor blind zone in cm
@@ -252,6 +521,10 @@ if __name__ == "__main__":
     # Perform the measurement and record the fuel oil level
     while True:
         distance = LevelSensor.read(temperature_c=22.8)
+        if distance < 0:
+            print('Sensor read timeout or invalid measurement')
+            lightsleep(5000)
+            continue
 
         print('distance from sensor: {:.2f} cm'.format(distance))
         liquid_height = tank.tank_height - distance
@@ -259,4 +532,4 @@ if __name__ == "__main__":
         liters = tank.to_liters(distance)
         # liters = tank.to_liters(liquid_height)
         print('Fuel oil capacity: {:.2f} L'.format(liters))
-        sleep(5)
\ No newline at end of file
+        lightsleep(5000)
\ No newline at end of file
@@ -1,155 +1,359 @@
 import ujson
-import uerrno
 import uos
+import ustruct
 import ntptime
 import gc
 
+from machine import deepsleep, RTC
 from utime import sleep_ms, mktime, gmtime, time
+from micropython import const
+
+try:
+    from machine import lightsleep
+except ImportError:
+    lightsleep = sleep_ms   # ports without light sleep keep waiting with the CPU running
+
+try:
+    import deflate          # zlib compression of the buffered history, needs MICROPY_PY_DEFLATE_COMPRESS
+    from io import BytesIO
+except ImportError:
+    deflate = None
+
+_DEBUG = const(0) # Set to 1 to print diagnostic traces (dropped at compile time otherwise)
+
+_rtc = RTC()      # RTC memory survives deep sleep, used to keep state between two cycles
+
+# RTC memory layout: last NTP sync time, last saved liters, temperature, humidity, saves skipped since
+_RTC_FMT = "<IfffH"
+_RTC_SIZE = const(18)
+_RTC_NO_SAVE = const(0xFFFF)  # skipped count on cold boot, nothing saved yet
+
+# Buffer file record header: topic length, payload length, retain, QoS, followed by the topic and payload
+_REC_HDR_FMT = "<HHBB"
+_REC_HDR_SIZE = const(6)
+
+# Buffer file of the previous firmware, "topic;payload;retain;qos" lines, and its flush spool file
+_LEGACY_FILES = ("data.csv.tmp", "data.csv")
 
 # -----------------------------------------------------------------------------
 # region FSM logic
 # -----------------------------------------------------------------------------
+def _rtc_load() -> list:
+    """ Read the state kept in RTC memory, defaults after a power loss """
+    mem = _rtc.memory()
+    if len(mem) < _RTC_SIZE:
+        return [0, 0.0, 0.0, 0.0, _RTC_NO_SAVE]
+    return list(ustruct.unpack_from(_RTC_FMT, mem))
+
+def _rtc_store(state: list) -> None:
+    _rtc.memory(ustruct.pack(_RTC_FMT, *state))
+
 def measurment(temp_sensor,
                level_sensor,
-               tank) -> tuple[float | None, float | None, float | None]:
+               tank,
+               out: dict) -> bool:
     """
-    Perform sensor measurements and return results.
-    
-    :return: Tuple of (temperature in °C, humidity in %, fuel volume in liters) or (None, None, None) on error
+    Perform sensor measurements and store the results in the caller's mapping.
+
+    :param out: Mapping receiving "temp" in °C, "hum" in % and "liters", the FSM context in main.py.
+    :return: True if all the values were measured, False on error
     """
     try:
         temp, hum = temp_sensor.read()
         distance = level_sensor.read(temperature_c=temp if temp is not None else 20.0)
-        liters = tank.to_liters(tank.tank_height - distance)
-        return temp, hum, liters
+        if distance < 0:
+            print("[MEASURE] Level sensor timeout or invalid measurement")
+            return False
+        if temp is None:
+            return False
+        out["temp"] = temp
+        out["hum"] = hum
+        out["liters"] = tank.to_liters(distance)   # to_liters takes the sensor distance, it derives the level itself
+        return True
     except Exception as e:
         print("[MEASURE] Measurement error:", e)
-        return None, None, None
+        return False
 
-def connection(wifi) -> bool | None:
+def connection(wifi,
+               poll_ms: int = 100) -> bool | None:
     """
     Test WiFi connection and NTP synchronization.
-    
+
+    The WiFi status flags only change on the WiFi manager FSM tick, so while still connecting
+    the call waits poll_ms before returning instead of letting the caller spin on the flags.
+
+    :param poll_ms: Wait in milliseconds before returning None.
     :return: True if connected successfully, 
              False if connection failed, 
              None if still connecting
     """
     try:
-        wifi.enable_connection = True
+        if not wifi.enable_connection:
+            wifi.enable_connection = True
+        # Each status property is read once, connection_failed only when not connected
         if wifi.is_connected:
-            print("[CONNECT] WiFi connected successfully")
+            if _DEBUG: print("[CONNECT] WiFi connected successfully")
             return True
-        elif wifi.connection_failed:
+        if wifi.connection_failed:
             print("[CONNECT] WiFi connection failed")
             return False
-        else:
-            return None
+        sleep_ms(poll_ms)
+        return None
     except Exception as e:
         print("[CONNECT] Connection error:", e)
+        return False
+
+def _publish_history(mqtt,
+                     filename: str,
+                     topic: bytes,
+                     min_bytes: int) -> bool | None:
+    """
+    Publish the whole buffer file as a single zlib-compressed QoS 1 message.
+
+    The payload is the compressed content of the buffer file, records keep their binary layout.
+
+    :param mqtt: The MQTT manager used to publish the message.
+    :param filename: The buffer file to publish.
+    :param topic: The topic of the history message.
+    :param min_bytes: Smaller files are not worth the zlib header and are replayed record by record.
+    :return: True if published, False if the publish failed, None if the file was not compressed.
+    """
+    if deflate is None or uos.stat(filename)[6] < min_bytes:
+        return None
+
+    compressed = BytesIO()
+    chunk = bytearray(256)
+    try:
+        with open(filename, "rb") as f:
+            z = deflate.DeflateIO(compressed, deflate.ZLIB)
+            while True:
+                n = f.readinto(chunk)
+                if not n:
+                    break
+                z.write(chunk if n == len(chunk) else chunk[:n])
+            z.close()   # flush the last block, the BytesIO stays open
+    except Exception as e:
+        # Firmware built without compression support
+        if _DEBUG: print("[FLUSH] History compression unavailable:", e)
+        return None
+
+    message = {"topic": topic, "payload": compressed.getvalue(), "retain": False, "qos": 1}
+    if _DEBUG: print("[FLUSH] History compressed to", len(message["payload"]), "bytes")
+    return send_data(mqtt=mqtt, messages=[message])
+
+def _migrate_legacy_buffer(filename: str,
+                           batch_size: int = 10) -> None:
+    """
+    Convert the records left in the text buffer of the previous firmware into the binary buffer file.
+
+    A legacy file is removed once all its records are appended, it is kept for the next flush otherwise.
+
+    :param filename: The binary buffer file the records are appended to.
+    :param batch_size: Number of records converted and appended at once.
+    """
+    for legacy in _LEGACY_FILES:
+        try:
+            uos.stat(legacy)
+        except OSError:
+            continue
+
+        migrated = True
+        messages = []
+        try:
+            with open(legacy, "r") as f:
+                for line in f:
+                    line = line.strip()
+                    if not line:
+                        continue
+                    parts = line.split(";")
+                    if len(parts) < 4:
+                        print("[FLUSH] Invalid legacy line, skipping:", line)
+                        continue
+                    # The payload was written unescaped, the fields around it are fixed
+                    messages.append({"topic": parts[0].encode(),
+                                     "payload": ";".join(parts[1:-2]).encode(),
+                                     "retain": parts[-2] == "1",
+                                     "qos": int(parts[-1])})
+                    if len(messages) == batch_size:
+                        if not save_data(messages, filename=filename):
+                            migrated = False
+                            break
+                        messages = []
+            if migrated and messages:
+                migrated = save_data(messages, filename=filename)
+        except Exception as e:
+            print("[FLUSH] Error migrating " + legacy + ":", e)
+            migrated = False
+
+        if migrated:
+            uos.remove(legacy)
+            print("[FLUSH] Migrated " + legacy + " to " + filename)
 
 def flush_data(mqtt,
-               csv_filename: str = "data.csv") -> bool:
+               filename: str = "data.bin",
+               batch_size: int = 10,
+               history_topic: bytes | None = None,
+               compress_min_bytes: int = 512) -> bool:
     """
-    Read data from the specified CSV file, print it, and delete the file.
+    Publish the records buffered in the specified file, then delete the file.
+
+    Records are sent in batches of batch_size messages, a batch that could not be sent is
+    written back to the file with the remaining records for the next flush.
+    With a history_topic, a buffer of at least compress_min_bytes is instead published as one
+    zlib-compressed message on that topic when the firmware supports compression.
     """
     # Spooling to separate data in process from data no processed yet in case of errors during processing
-    temp_filename = csv_filename + ".tmp"
+    temp_filename = filename + ".tmp"
+
+    # Records buffered by the previous firmware are converted once and flushed with the others
+    _migrate_legacy_buffer(filename)
 
     # Check if the file exists before trying to read it
     try:
-        uos.stat(csv_filename)  # Check if file exists
+        uos.stat(filename)  # Check if file exists
     except OSError:
-        print("[FLUSH] No buffered data to flush")
+        if _DEBUG: print("[FLUSH] No buffered data to flush")
         return True  # No file to flush, consider it successful
     
     # Safely rename the file to avoid conflicts
     try:
-        uos.rename(csv_filename, temp_filename)
-        print(f"[FLUSH] Renamed {csv_filename} to {temp_filename} for processing")
+        uos.rename(filename, temp_filename)
+        if _DEBUG: print("[FLUSH] Renamed %s to %s for processing" % (filename, temp_filename))
     except OSError:
         return False
 
+    if history_topic is not None:
+        sent = _publish_history(mqtt, temp_filename, history_topic, compress_min_bytes)
+        if sent is False:
+            # Nothing was appended meanwhile, the buffer file is simply restored for the next flush
+            print("[FLUSH] Failed to send buffered history, will retry later")
+            uos.rename(temp_filename, filename)
+            return False
+        if sent:
+            uos.remove(temp_filename)
+            return True
+
     flush_success = True
 
-    try:
-        with open(temp_filename, "r") as f:
-            print("[FLUSH] Reading data from " + temp_filename)
-            for line in f:
-                # If an error already occurred during flushing, save remaining lines back to original
-                if not flush_success:
-                    with open(csv_filename, "a") as original_f:
-                        original_f.write(line)
-                        continue
+    # Message descriptors reused for every batch of buffered records
+    batch = [{"topic": b"", "payload": b"", "retain": False, "qos": 0} for _ in range(batch_size)]
 
-                line = line.strip()
-                if not line:
-                    continue
-
-                parts = line.split(";")
-                if len(parts) >= 4:                    
-                    messages = {
-                        "topic": parts[0].encode(),
-                        "payload": parts[1].encode(),
-                        "retain": bool(int(parts[2])),
-                        "qos": int(parts[3])
-                    }
-        
-                    if send_data(mqtt=mqtt, messages=[messages]):
-                        sleep_ms(50)
-                    else:          
+    try:
+        # Records are streamed from the spool file one batch at a time, only a batch is held in memory
+        with open(temp_filename, "rb") as f:
+            if _DEBUG: print("[FLUSH] Reading data from " + temp_filename)
+            offset = 0
+            batch_start = 0             # file offset of the first record of the current batch
+            count = 0
+            while True:
+                # Record header gives the field lengths, no parsing or splitting of the fields
+                header = f.read(_REC_HDR_SIZE)
+                end_of_file = len(header) < _REC_HDR_SIZE
+                if not end_of_file:
+                    topic_len, payload_len, retain, qos = ustruct.unpack(_REC_HDR_FMT, header)
+                    topic = f.read(topic_len)
+                    payload = f.read(payload_len)
+                    end_of_file = len(topic) < topic_len or len(payload) < payload_len
+                if end_of_file:
+                    if header:
+                        print("[FLUSH] Truncated record at offset", offset, "dropped")
+                else:
+                    message = batch[count]
+                    message["topic"] = topic
+                    message["payload"] = payload
+                    message["retain"] = retain == 1
+                    message["qos"] = qos
+                    count += 1
+                    offset += _REC_HDR_SIZE + topic_len + payload_len
+
+                if count == batch_size or (count and end_of_file):
+                    if not send_data(mqtt=mqtt, messages=batch if count == batch_size else batch[:count]):
                         print("[FLUSH] Failed to send buffered data, will retry later")
                         flush_success = False
-                        # Save the current line to original file
-                        with open(csv_filename, "a") as original_f:
-                            original_f.write(line + "\n")
-                else:
-                    print("[FLUSH] Invalid line format, skipping:", line)
+                        # Copy the records of the current batch and the remaining ones back to the original file,
+                        # whole records only so a truncated tail does not shift the records appended later
+                        f.seek(batch_start)
+                        with open(filename, "ab") as original_f:
+                            while True:
+                                header = f.read(_REC_HDR_SIZE)
+                                if len(header) < _REC_HDR_SIZE:
+                                    break
+                                topic_len, payload_len, _, _ = ustruct.unpack(_REC_HDR_FMT, header)
+                                body = f.read(topic_len + payload_len)
+                                if len(body) < topic_len + payload_len:
+                                    break
+                                original_f.write(header)
+                                original_f.write(body)
+                        break
+                    batch_start = offset
+                    count = 0
+                    sleep_ms(50)
+
+                if end_of_file:
+                    break
     except Exception as e:
         print("[FLUSH] Error :", e)
         flush_success = False
         
     try:
         uos.remove(temp_filename)
-        print("[FLUSH] " + temp_filename + " flushed successfully")
+        if _DEBUG: print("[FLUSH] " + temp_filename + " flushed successfully")
     except OSError:
         print("[FLUSH] Error deleting " + temp_filename + ", will retry later")
 
     if flush_success:
-        print("[FLUSH] All buffered data flushed successfully")
+        if _DEBUG: print("[FLUSH] All buffered data flushed successfully")
     
     return flush_success
 
 
 def save_data(messages: list[dict],
-              csv_filename: str = "data.csv",
+              filename: str = "data.bin",
               max_retries: int = 3,
               retry_delay_ms: int = 100,
               max_size_bytes: int = 51200) -> bool:
     """
-    Save the provided data to a CSV file. Each entry is saved as a separate line in the file.
+    Append the provided messages to the buffer file, one binary record per message.
+
+    A record is a header (topic length, payload length, retain, QoS) followed by the raw topic and payload.
     """
     try:
         # uos.stat returns a tuple with file info, index 6 is the file size in bytes
-        file_size = uos.stat(csv_filename)[6] if uos.stat(csv_filename) else 0
+        file_size = uos.stat(filename)[6]
         if file_size >= max_size_bytes:
-            print(f"[SAVE] Warning: {csv_filename} reached max size ({file_size} bytes)... stopping save.")
+            print("[SAVE] Warning: %s reached max size (%d bytes)... stopping save." % (filename, file_size))
             return False
     except OSError:
         pass  # File does not exist yet, will be created
 
+    # Pack every record into one exactly sized buffer so all of them reach the flash in a single binary write
+    try:
+        total = 0
+        for msg in messages:
+            total += _REC_HDR_SIZE + len(msg.get("topic")) + len(msg.get("payload"))
+
+        data = bytearray(total)
+        offset = 0
+        for msg in messages:
+            topic = msg.get("topic")
+            payload = msg.get("payload")
+            retain = 1 if msg.get("retain", False) else 0
+
+            ustruct.pack_into(_REC_HDR_FMT, data, offset, len(topic), len(payload), retain, msg.get("qos", 0))
+            offset += _REC_HDR_SIZE
+            data[offset:offset + len(topic)] = topic
+            offset += len(topic)
+            data[offset:offset + len(payload)] = payload
+            offset += len(payload)
+    except Exception as e:
+        print("[SAVE] Error saving data:", e)
+        return False
+
     for attempt in range(max_retries):
         try:
-            with open(csv_filename, "a") as f:
-                for msg in messages:
-                    topic = msg.get("topic").decode()
-                    payload = msg.get("payload").decode()
-                    retain = 1 if msg.get("retain", False) else 0
-                    qos = msg.get("qos", 0)
-                    
-                    line = f"{topic};{payload};{retain};{qos}\n"
-                    f.write(line)
-                    print(f"[SAVE] Data saved to {csv_filename}: {line.strip()}")
-            print(f"[SAVE] Buffered {len(messages)} messages to {csv_filename}")
+            with open(filename, "ab") as f:
+                f.write(data)
+            if _DEBUG: print("[SAVE] Buffered %d messages (%d bytes) to %s" % (len(messages), len(data), filename))
             return True
         except OSError as e:
             print("[SAVE] Attempt failed with OSError while saving data:", e)
@@ -162,53 +366,88 @@ def save_data(messages: list[dict],
     print("[SAVE] Failed to save data after retries")
     return False
 
+def save_needed(liters: float,
+                temp_c: float,
+                hum: float,
+                deadband_l: float = 0.5,
+                deadband_c: float = 0.2,
+                deadband_hum: float = 1.0,
+                heartbeat: int = 12) -> bool:
+    """
+    Check whether a measurement differs enough from the last saved one to be buffered.
+
+    The last saved values are kept in RTC memory so the deadband holds across deep sleep.
+    An unchanged measurement is still saved every heartbeat cycles to tell a steady tank from a dead device.
+
+    :param heartbeat: Maximum number of skipped saves in a row
+    :return: True if the measurement must be saved, False if it is skipped
+    """
+    state = _rtc_load()
+    if (state[4] < heartbeat
+            and abs(liters - state[1]) < deadband_l
+            and abs(temp_c - state[2]) < deadband_c
+            and abs(hum - state[3]) < deadband_hum):
+        state[4] += 1
+        _rtc_store(state)
+        if _DEBUG: print("[SAVE] Measurement within deadband, skipped")
+        return False
+    return True
+
+def mark_saved(liters: float,
+               temp_c: float,
+               hum: float) -> None:
+    """ Remember the values of the last saved measurement in RTC memory """
+    state = _rtc_load()
+    state[1], state[2], state[3], state[4] = liters, temp_c, hum, 0
+    _rtc_store(state)
+
 def send_data(mqtt,
               messages: list[dict],
               max_retries: int = 3,
               retry_delay_ms: int = 500) -> bool:
     """
     Send current measurement data to server via MQTT.
+
+    All the messages are handed to the broker as one batch, retried as a whole on failure.
     
     :param mqtt: Initializes and connected MQTTManager instance.
     :param messages: List of dictionaries containing 'topic', 'payload', and optional 'retain' and 'qos'.
     """
+    for msg in messages:
+        if msg.get("topic") is None or msg.get("payload") is None:
+            print("[SEND] Invalid message format, missing topic or payload:", msg)
+            return False
 
-    try:
-        for msg in messages:
-            topic = msg.get("topic")
-            payload = msg.get("payload")
-            retain = msg.get("retain", False)
-            qos = msg.get("qos", 0)
+    for attempt in range(max_retries):
+        if mqtt.publish_batch(messages):
+            if _DEBUG:
+                for msg in messages:
+                    print("[SEND]", msg["topic"], msg["payload"], "published successfully")
+            return True
 
-            if topic is not None and payload is not None:
-                message_sent = False
+        print("[SEND] Attempt %d of %d failed" % (attempt + 1, max_retries))
+        if attempt < max_retries - 1:
+            sleep_ms(retry_delay_ms)
 
-                for attempt in range(max_retries):
-                    try:
-                        mqtt.publish(topic=topic, message=payload, retain=retain, qos=qos)
-                        message_sent = True
-                        break
-                    except OSError as e:
-                        print(f"[SEND] Attempt failed with OSError while sending {topic.decode()}: {e}")
-                        if attempt < max_retries - 1:
-                            sleep_ms(retry_delay_ms)
-
-                if not message_sent:
-                    return False
-                
-                print(f"[SEND] {topic.decode()}: {payload.decode()} published successfully")
-            else:
-                print("[SEND] Invalid message format, missing topic or payload:", msg)
-                return False
-        return True
-    except Exception as e:
-        print("[SEND] Error sending data:", e)
-        return False
+    return False
+
+def go_sleep(wifi,
+             duration_ms: int = 5000,
+             deep: bool = True) -> None:
+    """
+    Enter low power sleep mode until the next measurement cycle.
+
+    :param wifi: WifiManager instance to shut down before sleeping.
+    :param duration_ms: Sleep duration in milliseconds.
+    :param deep: If True, enter deep sleep: the device resets on wake up and main.py restarts
+                 from the MEASURE state. If False, enter light sleep and resume the main loop.
+    """
+    if deep:
+        wifi.stop()
+        deepsleep(duration_ms)
 
-def go_sleep(wifi) -> None:
-    """ Enter low power sleep mode (not implemented) """
     wifi.enable_connection = False
-    sleep_ms(5000)                                                                          # TODO: Implement actual deep sleep mode for power saving
+    lightsleep(duration_ms)
 
 # endregion
 
@@ -218,7 +457,6 @@ def go_sleep(wifi) -> None:
 def last_sunday(year: int,
                 month: int) -> int:
     # Returns the last Sunday of the given month and year
-
     # Determine next month and year based on current month
     if month == 12:
         next_month = (year + 1, 1)
@@ -233,74 +471,171 @@ def last_sunday(year: int,
     days_back = (tm[6] + 1) % 7
     return tm[2] - days_back
 
-def is_dst_brussels(utc_tm: tuple[int, int, int, int]) -> bool:
-    year = utc_tm[0]
-    month = utc_tm[1]
-    day = utc_tm[2]
-    hour = utc_tm[3]
+# UTC timestamps of the cached year: start and end of the year, start and end of its DST period
+_dst_cache = [0, -1, 0, 0]
 
-    # DST in Europe: last Sunday of March at 01:00 UTC
-    # ends last Sunday of October at 01:00 UTC
-    if month < 3 or month > 10:
-        return False
-    if 3 < month < 10:
-        return True
+def is_dst_brussels(t: int) -> bool:
+    """
+    Check whether Brussels is on summer time at a given time.
 
-    if month == 3:
-        last = last_sunday(year, 3)
-        # DST starts at 01:00 UTC
-        # Return True if we're past the last Sunday of March or it's the last Sunday and past 01:00 UTC
-        return (day > last) or (day == last and hour >= 3)
+    DST in Europe starts the last Sunday of March and ends the last Sunday of October, both at 01:00 UTC.
+    The bounds are computed once per year, afterwards the check is a single comparison.
 
-    if month == 10:
-        last = last_sunday(year, 10)
-        # DST ends at 01:00 UTC
-        # Return True if we're before the last Sunday of October or it's the last Sunday and before 01:00 UTC
-        return (day < last) or (day == last and hour < 3) 
+    :param t: UTC timestamp in seconds
+    :return: True during summer time
+    """
+    cache = _dst_cache
+    if not cache[0] <= t < cache[1]:
+        year = gmtime(t)[0]
+        cache[0] = mktime((year, 1, 1, 0, 0, 0, 0, 0))
+        cache[1] = mktime((year + 1, 1, 1, 0, 0, 0, 0, 0))
+        cache[2] = mktime((year, 3, last_sunday(year, 3), 1, 0, 0, 0, 0))
+        cache[3] = mktime((year, 10, last_sunday(year, 10), 1, 0, 0, 0, 0))
+    return cache[2] <= t < cache[3]
+
+# Date and time strings are written digit by digit into these buffers instead of formatted
+_DATE_BUF = bytearray(b"00/00/0000")
+_TIME_BUF = bytearray(b"00:00:00")
+
+def _put2(buf: bytearray,
+          offset: int,
+          n: int) -> None:
+    # Write n on two ASCII digits at offset
+    buf[offset] = 0x30 + n // 10
+    buf[offset + 1] = 0x30 + n % 10
 
 def localtime_brussels() -> tuple[str, str]:
-    utc = gmtime()  # UTC
-    offset = 2 if is_dst_brussels(utc) else 1  # UTC+2 in summer, UTC+1 in winter
+    t = time()  # UTC
+    offset = 2 if is_dst_brussels(t) else 1  # UTC+2 in summer, UTC+1 in winter
     # Calculate local time by adding the offset to the current UTC time
-    local_time = gmtime(time() + offset * 3600)
-    # Format local time as date and time strings (not used in return value but can be useful for debugging)
-    date_str = "{:02d}/{:02d}/{:04d}".format(local_time[2], # day
-                                             local_time[1], # month
-                                             local_time[0]) # year
-    time_str = "{:02d}:{:02d}:{:02d}".format(local_time[3], # hour
-                                             local_time[4], # minute
-                                             local_time[5]) # second
-    
-    # print("Current date (Brussels):", current_date)
-    # print("Current time (Brussels):", current_time)
+    local_time = gmtime(t + offset * 3600)
+
+    # Format local time as DD/MM/YYYY and HH:MM:SS strings
+    date_buf = _DATE_BUF
+    _put2(date_buf, 0, local_time[2])           # day
+    _put2(date_buf, 3, local_time[1])           # month
+    _put2(date_buf, 6, local_time[0] // 100)    # year
+    _put2(date_buf, 8, local_time[0] % 100)
+    time_buf = _TIME_BUF
+    _put2(time_buf, 0, local_time[3])           # hour
+    _put2(time_buf, 3, local_time[4])           # minute
+    _put2(time_buf, 6, local_time[5])           # second
+
+    return str(date_buf, "ascii"), str(time_buf, "ascii")
+
+def rtc_sync_due(interval_s: int = 3600) -> bool:
+    """
+    Check whether the RTC needs a new NTP synchronization.
 
-    return date_str, time_str
+    The time of the last synchronization is kept in RTC memory so the interval holds across deep sleep.
+    A power loss clears the memory and resets the RTC, both force a new synchronization.
 
-def update_rtc(max_retries: int = 3) -> None:
-    """ Update RTC time from NTP server """
-    for _ in range(max_retries):
+    :param interval_s: Minimum time between two synchronizations in seconds
+    :return: True if the RTC must be synchronized
+    """
+    last_sync = _rtc_load()[0]
+    if last_sync == 0:
+        return True
+    elapsed = time() - last_sync
+    return elapsed < 0 or elapsed >= interval_s
+
+def update_rtc(timeout_s: int = 1,
+               max_retries: int = 1,
+               retry_delay_ms: int = 100,
+               max_delay_ms: int = 5000) -> bool:
+    """
+    Update RTC time from NTP server and remember the synchronization time in RTC memory.
+
+    A single short attempt is made by default: on failure the RTC keeps running on its last time
+    and the synchronization is tried again on the next cycle.
+
+    :param timeout_s: NTP response timeout in seconds
+    :param max_retries: Number of attempts
+    :param retry_delay_ms: Delay before the second attempt in milliseconds, doubled after each failure
+    :param max_delay_ms: Upper bound of the delay between two attempts in milliseconds
+    :return: True if the RTC was synchronized
+    """
+    ntptime.timeout = timeout_s
+    delay = retry_delay_ms
+    for attempt in range(max_retries):
         try:
             ntptime.settime()
-            print("[RTC] Synchronized with NTP server")
             break
         except Exception as e:
-            sleep_ms(1000)
+            print("[RTC] Failed to synchronize:", e)
+            if attempt < max_retries - 1:
+                sleep_ms(delay)
+                delay = min(delay * 2, max_delay_ms)
     else:
-        print("[RTC] Failed to synchronize after retries")
+        return False
+
+    state = _rtc_load()
+    state[0] = time()
+    _rtc_store(state)
+    if _DEBUG: print("[RTC] Synchronized with NTP server")
+    return True
 
 # endregion
 
 # -----------------------------------------------------------------------------
 # region MISC
 # -----------------------------------------------------------------------------
+# Payload templates of the two fixed messages, formatted directly instead of going through a dict and ujson
+_JSON_TANK = '{"date":"%s","time":"%s","quantity_l":%s}'
+_JSON_CASE = '{"date":"%s","time":"%s","temp_c":%s,"hum":%s}'
+
 def data_to_json(**kwargs) -> bytes:
-    data = {k: v for k, v in kwargs.items() if v is not None}
-    
-    return ujson.dumps(data).encode()
+    # The kwargs dict is dumped as is unless a value has to be left out
+    for v in kwargs.values():
+        if v is None:
+            kwargs = {k: v for k, v in kwargs.items() if v is not None}
+            break
+
+    return ujson.dumps(kwargs).encode()
 
-def cleanup():
-    """ Perform garbage collection and cleanup """
-    gc.collect()
-    print("Garbage collection completed")
+def tank_to_json(date_str: str,
+                 time_str: str,
+                 quantity_l: float) -> bytes:
+    """
+    Serialize the tank message, same JSON as data_to_json(date=..., time=..., quantity_l=...).
+
+    :param date_str: Local date string.
+    :param time_str: Local time string.
+    :param quantity_l: Fuel oil volume in liters, left out of the payload if None.
+    :return: The JSON payload as bytes.
+    """
+    if quantity_l is None:
+        return data_to_json(date=date_str, time=time_str)
+    return (_JSON_TANK % (date_str, time_str, quantity_l)).encode()
+
+def case_to_json(date_str: str,
+                 time_str: str,
+                 temp_c: float,
+                 hum: float) -> bytes:
+    """
+    Serialize the case message, same JSON as data_to_json(date=..., time=..., temp_c=..., hum=...).
+
+    :param date_str: Local date string.
+    :param time_str: Local time string.
+    :param temp_c: Temperature in °C.
+    :param hum: Relative humidity in %.
+    :return: The JSON payload as bytes.
+    """
+    if temp_c is None or hum is None:
+        return data_to_json(date=date_str, time=time_str, temp_c=temp_c, hum=hum)
+    return (_JSON_CASE % (date_str, time_str, temp_c, hum)).encode()
+
+def cleanup(force: bool = False) -> None:
+    """
+    Perform garbage collection only when the allocated heap outgrows twice the free heap.
+
+    Routine collections are left to the gc.threshold set at startup, a forced collection is meant
+    for the points where large buffers were just released.
+
+    :param force: Collect regardless of the heap usage.
+    """
+    if force or gc.mem_alloc() > 2 * gc.mem_free():
+        gc.collect()
+        if _DEBUG: print("[GC] Garbage collection completed")
 
 # endregion
\ No newline at end of file
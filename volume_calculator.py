@@ -1,4 +1,20 @@
+import math
 from abc import ABC, abstractmethod
+from array import array
+
+try:
+    import micropython
+except ImportError:
+    # CPython (host-side log replay): the decorators leave plain Python functions
+    # and viper's ptr32 becomes the array itself, indexed the same way
+    class micropython:
+        native = viper = lambda f: f
+    ptr32 = lambda buf: buf
+
+try:
+    import numpy as np  # host-side log replay and calibration only, not available on MicroPython
+except ImportError:
+    np = None
 
 class VolumeCalculator(ABC):
     @abstractmethod
@@ -6,6 +22,20 @@ class VolumeCalculator(ABC):
         pass
 
 
+@micropython.viper
+def _lut_interp(lut, x_q: int) -> int:
+    """
+    Linearly interpolate an array('i') lookup table in integer arithmetic.
+
+    :param lut: array('i') of volumes in centiliters, one entry per table step.
+    :param x_q: Position in the table in 1/256 of a step, below (len(lut) - 1) * 256, not bounds checked.
+    :return: Interpolated volume in centiliters.
+    """
+    buf = ptr32(lut)
+    i = x_q >> 8
+    low = buf[i]
+    return low + (((buf[i + 1] - low) * (x_q & 255)) >> 8)
+
 class HexagonalPrismTank(VolumeCalculator):
     """
     Class to calculate the volume of fuel oil in a hexagonal prism tank 
@@ -27,13 +57,18 @@ class HexagonalPrismTank(VolumeCalculator):
         level_1 (float): Level at which the trapezoidal part is filled in cm
         level_2 (float): Level at which the rectangular part is filled in cm
         tank_height (float): Total height of the tank in cm
+        total_capacity (float): Volume of the full tank in liters
     
     Methods:
         to_liters(distance: float) -> float:
             Convert the fuel oil level in cm to volume in liters.
             :param distance: The distance from the sensor to the fuel oil surface in cm
             :return: The fuel oil volume in liters
+        to_liters_batch(distances) -> numpy.ndarray:
+            Convert an array of distances at once, requires NumPy (host side only).
     """
+    LUT_STEP = 0.5 # Level resolution of the volume lookup table in cm (below the sensor accuracy)
+
     def __init__(self,
                  tank_length: float,
                  h_rectangle: float,
@@ -52,76 +87,131 @@ class HexagonalPrismTank(VolumeCalculator):
         self.level_2 = h_trapeze + h_rectangle
         self.tank_height = self.level_2 + self.h_trapeze
 
-        # Pre-calculate part capacities
-        self.trapeze_capacity = self._calc_trapeze_volume(self.min_width, self.max_width, self.h_trapeze)
-        self.rectangle_capacity = self._calc_rectangle_volume(self.max_width, self.h_rectangle)
+        # Pre-calculate invariant coefficients used to build the lookup table
+        self._slope_up = (self.max_width - self.min_width) / self.h_trapeze    # width gain per cm in part 1
+        self._slope_dn = -self._slope_up                                        # width loss per cm in part 3
+        self._scale = 0.5 * self.tank_length * 0.001                            # 1/2 * length, /1000 for liters
+        self._rect_scale = self.max_width * self.tank_length * 0.001            # liters per cm in part 2
 
-    def _calc_trapeze_volume(self,
-                             side_a: float,
-                             side_b: float,
-                             height: float) -> float:
-        """
-        Calculate the volume of a trapezoidal section of the tank.
-        
-        :param side_a: The length of one parallel side of the trapezoid in cm
-        :type side_a: float
-        :param side_b: The length of the other parallel side of the trapezoid in cm
-        :type side_b: float
-        :param height: The height of the trapezoidal section in cm
-        :type height: float
-        :return: The volume of the trapezoidal section in liters
-        :rtype: float
-        """
-        area = (side_a + side_b) / 2 * height
-        return (area * self.tank_length) / 1000  # /1000 for capacity in liters
-    
-    def _calc_rectangle_volume(self,
-                               side: float,
-                               height: float) -> float:
+        # Pre-calculate part capacities: trapeze area (a + b) / 2 * h and rectangle area b * h, times the length
+        self.trapeze_capacity = (self.min_width + self.max_width) * self.h_trapeze * self._scale
+        self.rectangle_capacity = self.h_rectangle * self._rect_scale
+        self.total_capacity = round(2 * self.trapeze_capacity + self.rectangle_capacity, 2)
+
+        # Pre-calculate the level to volume lookup table, one entry every LUT_STEP cm, in centiliters
+        # so the interpolation runs in integer arithmetic
+        self._lut_scale = 256.0 / self.LUT_STEP     # level in cm to position in 1/256 of a table step
+        self._lut_last = math.ceil(self.tank_height / self.LUT_STEP)
+        self._lut = array('i', [int(self._calc_volume(i * self.LUT_STEP) * 100 + 0.5)
+                                for i in range(self._lut_last + 1)])
+        self._lut_x_max = (self._lut_last << 8) - 1   # last position whose next entry is still in the table
+
+        # Last conversion, the level changes slowly so consecutive readings often repeat (light sleep only,
+        # deep sleep rebuilds the object every cycle); keyed on the exact distance so a hit never returns
+        # the volume of a neighbouring reading
+        self._last_distance = None
+        self._last_volume = 0.0
+
+    def _calc_volume(self,
+                     current_level: float) -> float:
         """
-        Calculate the volume of a rectangular section of the tank.
+        Calculate the exact fuel oil volume for a given level, used to build the lookup table.
 
-        :param side: The length of the side of the rectangle in cm
-        :type side: float
-        :param height: The height of the rectangular section in cm
-        :type height: float
-        :return: The volume of the rectangular section in liters
+        :param current_level: The fuel oil level from the bottom of the tank in cm
+        :type current_level: float
+        :return: The volume of fuel oil in liters
         :rtype: float
         """
-        return (side * height * self.tank_length) / 1000  # /1000 for capacity in liters
+        min_width = self.min_width
+        max_width = self.max_width
+        level_1 = self.level_1
+        level_2 = self.level_2
+        scale = self._scale
+
+        # Clamp the level to the tank first, every part below then yields a non-negative volume
+        if current_level < 0.0:
+            current_level = 0.0
+        elif current_level > self.tank_height:
+            current_level = self.tank_height
 
+        if current_level <= level_1:
+            # Fuel only in part 1
+            volume = (min_width + min_width + self._slope_up * current_level) * current_level * scale
+        elif current_level <= level_2:
+            # Part 1 filled + Part 2 partially filled
+            relative_level = current_level - level_1
+            volume = relative_level * self._rect_scale + self.trapeze_capacity
+        else:
+            # Parts 1 and 2 filled + Part 3 partially or fully filled
+            relative_level = current_level - level_2
+            volume = (max_width + max_width + self._slope_dn * relative_level) * relative_level * scale
+            volume = volume + self.trapeze_capacity + self.rectangle_capacity
+
+        return volume
+
+    @micropython.native
     def to_liters(self,
                   distance: float) -> float:
         """
         Convert the fuel oil level in cm to volume in liters.
+
+        The volume is linearly interpolated in the lookup table built at initialization,
+        by a viper helper working on integer centiliters.
         
         :param distance: The distance from the sensor to the fuel oil surface in cm
         :type distance: float
         :return: The volume of fuel oil in liters
         :rtype: float
         """
+        if distance == self._last_distance:
+            return self._last_volume
+
         current_level = self.tank_height - distance
-        volume = 0
+        if current_level <= 0.0:
+            volume = 0.0                    # empty tank or echo beyond the bottom
+        elif current_level >= self.tank_height:
+            volume = self.total_capacity    # full tank or echo inside the blind zone
+        else:
+            x_q = int(current_level * self._lut_scale)  # position in the lookup table in 1/256 steps
+            if x_q > self._lut_x_max:
+                x_q = self._lut_x_max                   # float rounding just below the full level, ptr32 is unchecked
+            volume = _lut_interp(self._lut, x_q) / 100
 
-        if current_level <= self.level_1:
-            # Fuel only in part 1
-            surface = self.min_width + (self.max_width - self.min_width) / self.h_trapeze * current_level
-            volume = (1/2 * (self.min_width + surface) * current_level * self.tank_length) / 1000  # /1000 for capacity in liters
-        elif (current_level > self.level_1) & (current_level <= self.level_2):
-            # Part 1 filled + Part 2 partially filled
-            relative_level = current_level - self.level_1
-            volume = self.trapeze_capacity + self._calc_rectangle_volume(self.max_width, relative_level)
-            # volume = (current_level * self.max_width * self.tank_length)/1000  # /1000 for capacity in liters
-            # volume = volume + self.trapeze_capacity
-        elif (current_level > self.level_2) & (current_level <= self.tank_height):
-            # Parts 1 and 2 filled + Part 3 partially or fully filled
-            relative_level = current_level - self.level_2
+        self._last_distance = distance
+        self._last_volume = volume
+        return volume
 
-            surface = self.max_width + (self.min_width - self.max_width) / self.h_trapeze * relative_level
-            volume = (1/2 * (self.max_width + surface) * relative_level * self.tank_length) / 1000   # /1000 for capacity in liters
-            volume = volume + self.trapeze_capacity + self.rectangle_capacity
+    def to_liters_batch(self,
+                        distances):
+        """
+        Convert an array of sensor distances to volumes in liters, for host-side log replay.
+
+        The lookup table of to_liters is interpolated over the whole array with the same
+        integer arithmetic, the results are identical, levels outside the tank are clamped to empty or full.
+
+        :param distances: The distances from the sensor to the fuel oil surface in cm, array-like
+        :type distances: numpy.ndarray
+        :return: The volumes of fuel oil in liters
+        :rtype: numpy.ndarray
+        """
+        if np is None:
+            raise ImportError("to_liters_batch requires NumPy")
+        levels = self.tank_height - np.asarray(distances, dtype=float)
+        lut = np.array(self._lut, dtype=np.int64)
+        x_q = (np.clip(levels, 0.0, self.tank_height) * self._lut_scale).astype(np.int64)
+        x_q = np.minimum(x_q, self._lut_x_max)     # keeps i + 1 in the table, clamped levels are replaced below
+        i = x_q >> 8
+        low = lut[i]
+        volumes = (low + (((lut[i + 1] - low) * (x_q & 255)) >> 8)) / 100
+        volumes = np.where(levels <= 0.0, 0.0, volumes)
+        return np.where(levels >= self.tank_height, self.total_capacity, volumes)
 
-        if volume < 0:
-            volume = 0
+# --------------------------------------------------------------------------------------------------------
 
-        return round(volume, 2)
\ No newline at end of file
+if __name__ == "__main__":
+    # Host check (CPython with NumPy): the batch conversion matches to_liters over the whole range and beyond
+    tank = HexagonalPrismTank(tank_length=250, h_rectangle=45.5, h_trapeze=59.5, min_width=53, max_width=74)
+    distances = np.arange(-10.0, tank.tank_height + 10.0, 0.01)
+    batch = tank.to_liters_batch(distances)
+    single = np.array([tank.to_liters(float(d)) for d in distances])
+    print("Max difference:", np.abs(batch - single).max(), "L over", len(distances), "distances")
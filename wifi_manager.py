@@ -4,6 +4,38 @@ import gc
 import micropython
 from machine import Pin, Timer
 import socket
+import select
+import errno
+import sys
+from micropython import const
+
+# FSM states, small ints compared by value and inlined at compile time
+_ST_DISCONNECTED = const(0)
+_ST_CONNECTING   = const(1)
+_ST_CONNECTED    = const(2)
+_ST_ERROR        = const(3)
+
+_TICK_MS = const(200)           # FSM period while connecting, gives time to the SDK and drives the LED blink
+
+# FSM period of each state in ms, indexed by state: once connected only the link is monitored,
+# the error pause is timed in ms and only blinks the LED
+_TICK_PERIODS = (
+    _TICK_MS,   # _ST_DISCONNECTED
+    _TICK_MS,   # _ST_CONNECTING
+    2000,       # _ST_CONNECTED
+    500,        # _ST_ERROR
+)
+
+_ERROR_PAUSE_MS = const(10000)  # rest in the ERROR state before a new connection procedure
+
+# The esp32 port (ESP32-C3 included) has no virtual timer, the id selects a hardware timer group and index
+# and -1 would silently map to another hardware timer; the ports that have one use -1 to keep the hardware ones free
+_TIMER_ID = 0 if sys.platform == "esp32" else -1
+
+_NO_IP = "0.0.0.0"              # address reported by ifconfig() before DHCP completes
+_STAT_GOT_IP = getattr(network, "STAT_GOT_IP", None)    # status() once an address is assigned, if the port has it
+_STAT_WRONG_PASSWORD = getattr(network, "STAT_WRONG_PASSWORD", None)
+_STAT_NO_AP_FOUND = getattr(network, "STAT_NO_AP_FOUND", None)
 
 class WifiManager:
     """
@@ -16,7 +48,10 @@ class WifiManager:
         led_polarity (str, optional): Polarity of the LED, either "HI" for active high or "LO" for active low. Defaults to "HI".
         max_retries (int, optional): Maximum number of connection attempts before giving up. Defaults to 5.
         retry_delay (int, optional): Delay in seconds between connection attempts. Defaults to 2.
-        connect_timeout (int, optional): Timeout in seconds for each connection attempt. Defaults to 20.
+        connect_timeout (int, optional): Time budget in seconds of one connection procedure, all its attempts included. Defaults to 10.
+        probe_host (str, optional): IP address probed by check_internet. Defaults to Google's DNS server "8.8.8.8".
+        probe_port (int, optional): TCP port probed by check_internet. Defaults to 53.
+        probe_ttl_ms (int, optional): Time during which the last probe result is reused, in ms. Defaults to 5000.
 
     Attributes:
         enable_connection (bool): Flag to enable or disable the connection process.
@@ -29,23 +64,28 @@ class WifiManager:
             Start the WiFi manager and its internal FSM.
         stop() -> None:
             Stop the WiFi manager and disconnect from WiFi.
-        check_internet(host: str = "8.8.8.8") -> bool:
-            Check if the internet is reachable by pinging a host. Defaults to Google's DNS server.
+        check_internet(timeout: int = 3) -> bool:
+            Check if the internet is reachable by opening a TCP connection to the probe host.
+        check_internet_poll(timeout_ms: int = 3000) -> bool | None:
+            Same check without blocking, None while the probe connection is in progress.
     """
 
-    STATE_DISCONNECTED = 'disconnected'
-    STATE_CONNECTING   = 'connecting'
-    STATE_CONNECTED    = 'connected'
-    STATE_ERROR        = 'error'
+    STATE_DISCONNECTED = _ST_DISCONNECTED
+    STATE_CONNECTING   = _ST_CONNECTING
+    STATE_CONNECTED    = _ST_CONNECTED
+    STATE_ERROR        = _ST_ERROR
 
     def __init__(self, ssid: str, 
                  password: str, led_pin: str = "OFF",
                  led_polarity: str = "HI",
                  max_retries: int = 5,
                  retry_delay: int = 2,
-                 connect_timeout: int = 20,
+                 connect_timeout: int = 10,
                  max_error_count: int = 3,
-                 verbose: bool = True) -> None:
+                 verbose: bool = True,
+                 probe_host: str = "8.8.8.8",
+                 probe_port: int = 53,
+                 probe_ttl_ms: int = 5000) -> None:
         # Control flags and status indicators
         self.enable_connection = False
         self.is_connected = False
@@ -56,16 +96,23 @@ class WifiManager:
         self._ssid = ssid
         self._password = password
         self._max_retries = max_retries
-        self._retry_delay = retry_delay
-        self._connect_timeout = connect_timeout
+        self._retry_delay_ms = retry_delay * 1000
+        self._connect_timeout_ms = connect_timeout * 1000
         self._max_error_count = max_error_count
         self._verbose = verbose
+        # The probe host is a literal IP, resolving it here needs no DNS and is done once
+        self._probe_addr = socket.getaddrinfo(probe_host, probe_port, 0, socket.SOCK_STREAM)[0][-1]
+        self._probe_ttl_ms = probe_ttl_ms
+        self._last_probe_ms = None
+        self._probe_sock = None         # socket of the non-blocking probe in progress
+        self._probe_poll = None
+        self._probe_deadline = 0
 
         # Internal state variables for FSM and LED management
         self._attempt_count = 0
-        self._last_action_ms = 0
+        self._retry_at = 0              # ticks_ms deadline of the next attempt, or of the end of the error pause
+        self._connect_end = 0           # ticks_ms deadline of the connection procedure in progress
         self._error_count = 0
-        self._blink_state = False
         self._tick_count = 0
 
         # Initialize WLAN in station mode
@@ -78,12 +125,41 @@ class WifiManager:
         if led_pin != "OFF":
             self._led = Pin(led_pin, Pin.OUT)
             self._led_polarity_mask = 0 if led_polarity.upper() == "HI" else 1
+            self._led_levels = (self._led_polarity_mask, 1 ^ self._led_polarity_mask)  # pin level for off, on
             self._set_led(False)
         
         # FSM setup
-        self._fsm_timer = Timer(0) 
-        self._state = self.STATE_DISCONNECTED
-        self._fsm_ref = self._fsm_logic # Reference for the scheduler
+        try:
+            self._fsm_timer = Timer(_TIMER_ID)
+        except ValueError:
+            self._fsm_timer = Timer(0)      # port without virtual timer
+        self._tick_period_ms = _TICK_MS
+        self._state = _ST_DISCONNECTED
+        # State handlers indexed by state
+        self._handlers = (
+            self._handle_disconnected,  # _ST_DISCONNECTED
+            self._handle_connecting,    # _ST_CONNECTING
+            self._handle_connected,     # _ST_CONNECTED
+            self._handle_error,         # _ST_ERROR
+        )
+        # Timer callback closing over the scheduler and the bound FSM, no attribute lookup in IRQ context
+        schedule = micropython.schedule
+        fsm = self._fsm_logic # Reference for the scheduler, bound once
+        # [0] set while a scheduled FSM tick has not run to completion, [1] ticks dropped since (wraps at 256)
+        pending = self._pending = bytearray(2)
+        def timer_callback(t: Timer) -> None:
+            # We do NOTHING here, we delegate everything to the scheduler
+            if pending[0]:
+                pending[1] = (pending[1] + 1) & 0xFF
+                return              # the previous tick is still queued or running, do not queue a second one
+            try:
+                schedule(fsm, 0)
+            except RuntimeError:
+                # Scheduler queue full (main thread stalled), drop this tick, the next one retries
+                pending[1] = (pending[1] + 1) & 0xFF
+                return
+            pending[0] = 1
+        self._timer_callback = timer_callback
 
     def _set_led(self, state: bool) -> None:
         """
@@ -93,8 +169,134 @@ class WifiManager:
         :return: None
         """
         if self._led:
-            self._led.value(int(state) ^ self._led_polarity_mask)
+            self._led.value(self._led_levels[state])
+
+    def _handle_disconnected(self, now: int) -> int:
+        """
+        DISCONNECTED state: stay offline until the connection is enabled.
+
+        :param now: Current time in ms from utime.ticks_ms().
+        :return: The next state.
+        """
+        self.wlan.disconnect()
+        self.is_connected = False
+        self.has_connectivity = False
+        self.connection_failed = False
+        self._set_led(True)
+        if self.enable_connection:
+            if self._verbose: print("[WiFi] Connection enabled, starting connection procedure...")
+            self._attempt_count = 0
+            self.connection_failed = False
+            self._retry_at = now # Force immediate connection
+            self._connect_end = utime.ticks_add(now, self._connect_timeout_ms)
+            return _ST_CONNECTING
+        return _ST_DISCONNECTED
+
+    @micropython.native
+    def _handle_connecting(self, now: int) -> int:
+        """
+        CONNECTING state: start the connection attempts and wait for an IP address.
+
+        :param now: Current time in ms from utime.ticks_ms().
+        :return: The next state.
+        """
+        wlan = self.wlan
+        verbose = self._verbose
+
+        # 1. Blink management
+        self._set_led(not self._tick_count & 4)     # 4 ticks on, 4 ticks off
+
+        # 2. If not currently attempting, start an attempt
+        # An attempt is pending while the driver reports it is still connecting, the whole procedure is bounded
+        # by connect_timeout: the esp32 driver keeps reconnecting, and reports connecting, while the AP is absent
+        status = wlan.status()
+        if self._attempt_count and (status == _STAT_WRONG_PASSWORD or status == _STAT_NO_AP_FOUND):
+            # The driver reports why the attempt failed, retrying the same credentials right away cannot help
+            if verbose: print("[WiFi] Attempt failed, status", status)
+            self._error_count += 1
+            if status == _STAT_WRONG_PASSWORD:
+                self._error_count = self._max_error_count   # permanent, give up after the error pause
+            self._retry_at = utime.ticks_add(now, _ERROR_PAUSE_MS)
+            return _ST_ERROR
+        connected = status == _STAT_GOT_IP if _STAT_GOT_IP is not None else wlan.isconnected()
+        # Deadlines are set when the procedure or an attempt starts, each check is a single ticks_diff sign test
+        timed_out = utime.ticks_diff(now, self._connect_end) >= 0
+        if not connected and (timed_out or (status != network.STAT_CONNECTING
+                                            and utime.ticks_diff(now, self._retry_at) >= 0)):
+            if not timed_out and self._attempt_count < self._max_retries:
+                wlan.disconnect() # Ensure we start clean
+                try :
+                    wlan.connect(self._ssid, self._password)
+                    self._attempt_count += 1
+                    if verbose: print("[WiFi] Attempt", self._attempt_count, "of", self._max_retries)
+                    self._retry_at = utime.ticks_add(now, self._retry_delay_ms)
+                except OSError as e:
+                    if verbose: print("[WiFi Error] Driver currently busy:", e)
+            elif not self.enable_connection:
+                self._error_count = 0
+                if verbose: print("[WiFi] Connection disabled.")
+                return _ST_DISCONNECTED
+            else:
+                if verbose: print("[WiFi] Total failure.")
+                self._error_count += 1
+                self._retry_at = utime.ticks_add(now, _ERROR_PAUSE_MS)
+                return _ST_ERROR
+
+        # 3. Success check, a new attempt started above cannot be connected yet
+        if connected:
+            # STAT_GOT_IP implies an address, otherwise check it: ifconfig() builds a new tuple of strings
+            if _STAT_GOT_IP is None and wlan.ifconfig()[0] == _NO_IP:
+                return _ST_CONNECTING
+            if verbose: print("[WiFi] Connected! IP:", wlan.ifconfig()[0])
+            self.is_connected = True
+            self._error_count = 0
+            self._set_led(True)
+            return _ST_CONNECTED
+        return _ST_CONNECTING
+
+    def _handle_connected(self, now: int) -> int:
+        """
+        CONNECTED state: monitor the link.
+
+        :param now: Current time in ms from utime.ticks_ms().
+        :return: The next state.
+        """
+        self._set_led(False)
+        if not self.wlan.isconnected():
+            if self._verbose: print("[WiFi] Link lost!")
+            self.is_connected = False
+            return _ST_DISCONNECTED
+        if not self.enable_connection:
+            self._error_count = 0
+            if self._verbose: print("[WiFi] Connection disabled.")
+            return _ST_DISCONNECTED
+        return _ST_CONNECTED
+
+    def _handle_error(self, now: int) -> int:
+        """
+        ERROR state: pause before a new connection procedure.
 
+        :param now: Current time in ms from utime.ticks_ms().
+        :return: The next state.
+        """
+        # Fast blink
+        self._set_led(not self._tick_count & 1)
+        if self._error_count >= self._max_error_count:
+            if self._verbose: print("[WiFi] Maximum error count reached. Stopping attempts.")
+            self._error_count = 0
+            self.enable_connection = False
+            self.connection_failed = True
+        
+        if utime.ticks_diff(now, self._retry_at) >= 0: # end of the error pause
+            gc.collect() # Clean up before retrying, the pause is already long
+            return _ST_DISCONNECTED
+        if not self.enable_connection:
+            self._error_count = 0
+            if self._verbose: print("[WiFi] Connection disabled.")
+            return _ST_DISCONNECTED
+        return _ST_ERROR
+
+    @micropython.native
     def _fsm_logic(self, _) -> None:
         """
         Finite State Machine logic for WiFi management.
@@ -103,106 +305,33 @@ class WifiManager:
         :return: None
         """
         try:
-            now = utime.ticks_ms()
-            self._tick_count += 1
-            
-            # --- STATE: DISCONNECTED ---
-            if self._state == self.STATE_DISCONNECTED:
-                gc.collect() # Clean up before connection attempt
-                self.wlan.disconnect()
-                self.is_connected = False
-                self.has_connectivity = False
-                self.connection_failed = False
-                self._set_led(True)
-                if self.enable_connection:
-                    if self._verbose: print("[WiFi] Connection enabled, starting connection procedure...")
-                    self._attempt_count = 0
-                    self.connection_failed = False
-                    self._state = self.STATE_CONNECTING
-                    self._last_action_ms = 0 # Force immediate connection
-
-            # --- STATE: CONNECTING ---
-            elif self._state == self.STATE_CONNECTING:
-                # 1. Blink management
-                self._set_led((self._tick_count // 5) % 2 == 0)
-
-                # 2. If not currently attempting, start an attempt
-                if not self.wlan.isconnected() and utime.ticks_diff(now, self._last_action_ms) > (self._retry_delay * 1000):
-                    if self._attempt_count < self._max_retries:
-                        gc.collect() # Clean up before connection attempt
-                        self.wlan.disconnect() # Ensure we start clean
-                        try :
-                            self.wlan.connect(self._ssid, self._password)
-                            self._attempt_count += 1
-                            if self._verbose: print(f"[WiFi] Attempt {self._attempt_count}/{self._max_retries}")
-                            self._last_action_ms = now
-                        except Exception as e:
-                            if self._verbose: print(f"[WiFi Error] Driver currently busy: {e}")
-                            pass
-                    elif not self.enable_connection:
-                        self._error_count = 0
-                        self._state = self.STATE_DISCONNECTED
-                        self._last_action_ms = now
-                        if self._verbose: print("[WiFi] Connection disabled.")
-                    else:
-                        if self._verbose: print("[WiFi] Total failure.")
-                        self._error_count += 1
-                        self._state = self.STATE_ERROR
-                        self._last_action_ms = now
-
-                # 3. Success check
-                if self.wlan.isconnected():
-                    # Check if we have an IP
-                    if self.wlan.ifconfig()[0] != '0.0.0.0':
-                        print(f"[WiFi] Connected! IP: {self.wlan.ifconfig()[0]}")
-                        self.is_connected = True
-                        self._error_count = 0
-                        self._state = self.STATE_CONNECTED
-                        self._set_led(True)
-
-            # --- STATE: CONNECTED (Monitoring) ---
-            elif self._state == self.STATE_CONNECTED:
-                self._set_led(False)
-                if not self.wlan.isconnected():
-                    if self._verbose: print("[WiFi] Link lost!")
-                    self.is_connected = False
-                    self._state = self.STATE_DISCONNECTED
-                    gc.collect() # Clean up after disconnection
-                elif not self.enable_connection:
-                    self._error_count = 0
-                    self._state = self.STATE_DISCONNECTED
-                    if self._verbose: print("[WiFi] Connection disabled.")
-
-            # --- STATE: ERROR (Pause before reset) ---
-            elif self._state == self.STATE_ERROR:
-                # Fast blink
-                self._set_led(self._tick_count % 2 == 0)
-                if self._error_count >= self._max_error_count:
-                    if self._verbose: print("[WiFi] Maximum error count reached. Stopping attempts.")
-                    self._error_count = 0
-                    self.enable_connection = False
-                    self.connection_failed = True
-                
-                if utime.ticks_diff(now, self._last_action_ms) > 10000: # 10s rest
-                    self._state = self.STATE_DISCONNECTED
-                elif not self.enable_connection:
-                    self._error_count = 0
-                    self._state = self.STATE_DISCONNECTED
-                    if self._verbose: print("[WiFi] Connection disabled.")
-
-        except Exception as e:
-            # If an error occurs, we do NOT kill the timer, we just print
-            if self._verbose: print(f"[WiFi Critical Error] {e}")
-
-    def _timer_callback(self, t: Timer) -> None:
+            self._tick_count = (self._tick_count + 1) & 0xFF   # only the low bits drive the blink
+            # The state indexes its handler, no comparison chain, the handler returns the next state
+            state = self._handlers[self._state](utime.ticks_ms())
+            if state != self._state:
+                self._state = state
+                self._set_tick_period(_TICK_PERIODS[state])
+
+        except OSError as e:
+            # A driver error does NOT kill the timer, we just print; other exceptions are bugs and propagate
+            if self._verbose: print("[WiFi Critical Error]", e)
+        finally:
+            # Cleared at the end, the timer ticks that fire while the FSM runs are dropped and counted
+            pending = self._pending
+            if self._verbose and pending[1]: print("[WiFi] Dropped ticks:", pending[1])
+            pending[0] = pending[1] = 0
+
+    def _set_tick_period(self, period_ms: int) -> None:
         """
-        Timer callback for the WiFi manager.
-        
-        :param t: The timer object triggering the callback.
+        Restart the FSM timer with a new period if it changed.
+
+        :param period_ms: The FSM tick period in ms.
         :return: None
         """
-        # We do NOTHING here, we delegate everything to the scheduler
-        micropython.schedule(self._fsm_ref, 0)
+        if period_ms != self._tick_period_ms:
+            self._tick_period_ms = period_ms
+            self._fsm_timer.deinit()
+            self._fsm_timer.init(period=period_ms, mode=Timer.PERIODIC, callback=self._timer_callback)
 
     def start(self) -> None:
         """
@@ -212,7 +341,8 @@ class WifiManager:
         """
         if self._verbose: print("[WiFi] Manager started")
         # We trigger the measurement every 200ms to give time to the SDK
-        self._fsm_timer.init(period=200, mode=Timer.PERIODIC, callback=self._timer_callback)
+        self._tick_period_ms = _TICK_MS
+        self._fsm_timer.init(period=_TICK_MS, mode=Timer.PERIODIC, callback=self._timer_callback)
 
     def stop(self) -> None:
         """
@@ -229,38 +359,90 @@ class WifiManager:
         self.has_connectivity = False
         self.connection_failed = False
         self._set_led(False)
-        self._state = self.STATE_DISCONNECTED
+        self._state = _ST_DISCONNECTED
     
     def check_internet(self,
-                       host: str = "8.8.8.8",
-                       port: int = 53,
                        timeout: int = 3) -> bool:
         """
-        Check internet connectivity by attempting to connect to a specified host and port.
+        Check internet connectivity by attempting a TCP connection to the probe host and port.
+
+        A result younger than probe_ttl_ms is returned without a new probe.
         
-        :param host: The host to connect to (default is Google's DNS server 8.8.8.8).
-        :param port: The port to connect to (default is 53, DNS service).
         :param timeout: The timeout for the connection attempt in seconds (default is 3).
         :return: True if the internet is reachable, False otherwise.
         """
         if not self.is_connected:
             return False
+        now = utime.ticks_ms()
+        if self._last_probe_ms is not None and utime.ticks_diff(now, self._last_probe_ms) < self._probe_ttl_ms:
+            return self.has_connectivity
+        # We do not even go through DNS (we use the direct IP)
+        # to avoid blocking if the router's DNS server fails.
+        s = socket.socket()
+        s.settimeout(timeout)
         try:
-            # We do not even go through DNS (we use the direct IP)
-            # to avoid blocking if the router's DNS server fails.
-            gc.collect() # Clean up before socket operation
-            addr = (host, port)
-            s = socket.socket()
-            s.settimeout(timeout)
-            s.connect(addr) # Brutal connection attempt
-            s.close()
+            s.connect(self._probe_addr) # Brutal connection attempt
             self.has_connectivity = True
-            return True
-        except:
-            gc.collect() # Clean up after failure
+        except OSError:
             self.has_connectivity = False
+        finally:
+            s.close() # Always release the socket, also on timeout
+        self._last_probe_ms = utime.ticks_ms()
+        return self.has_connectivity
+
+    def check_internet_poll(self,
+                            timeout_ms: int = 3000) -> bool | None:
+        """
+        Check internet connectivity like check_internet, without blocking the caller.
+
+        The first call starts a non-blocking TCP connection to the probe host, the following calls
+        poll it until it completes or timeout_ms expires.
+
+        :param timeout_ms: Time budget of the probe connection in ms (default is 3000).
+        :return: True if the internet is reachable, False if not, None while the probe is in progress.
+        """
+        if not self.is_connected:
+            if self._probe_sock is not None:
+                self._probe_done(False)
             return False
 
+        if self._probe_sock is None:
+            if self._last_probe_ms is not None and utime.ticks_diff(utime.ticks_ms(), self._last_probe_ms) < self._probe_ttl_ms:
+                return self.has_connectivity
+            s = socket.socket()
+            s.setblocking(False)
+            self._probe_sock = s
+            try:
+                s.connect(self._probe_addr)
+            except OSError as e:
+                if e.args[0] != errno.EINPROGRESS:
+                    return self._probe_done(False)
+            self._probe_poll = select.poll()
+            self._probe_poll.register(s, select.POLLOUT)
+            self._probe_deadline = utime.ticks_add(utime.ticks_ms(), timeout_ms)
+
+        events = self._probe_poll.poll(0)
+        if events:
+            # Writable once connected, an error or hang up flag means the connection was refused
+            return self._probe_done(not events[0][1] & (select.POLLERR | select.POLLHUP))
+        if utime.ticks_diff(self._probe_deadline, utime.ticks_ms()) <= 0:
+            return self._probe_done(False)
+        return None
+
+    def _probe_done(self, reachable: bool) -> bool:
+        """
+        Close the non-blocking probe and record its result.
+
+        :param reachable: Result of the probe.
+        :return: The result of the probe.
+        """
+        self._probe_sock.close()
+        self._probe_sock = None
+        self._probe_poll = None
+        self.has_connectivity = reachable
+        self._last_probe_ms = utime.ticks_ms()
+        return reachable
+
 # --------------------------------------------------------------------------------------------------------
 
 if __name__ == "__main__":